@@ -0,0 +1,240 @@
+# bench_api.py — офлайн нагрузочный прогон fastapi_app: in-process ASGI, временная БД, фейковые OpenAI и Telegram
+#
+#   python bench_api.py --users 10000 --meals 10000000 --concurrency 64 --duration 60 --out bench.json
+#
+# Сидированную БД можно переиспользовать между прогонами: --workdir /tmp/calbench (сидинг пропускается,
+# если meals уже заполнена). Результат — JSON: параметры, коммит, RPS и p50/p95/p99 по каждой операции.
+import os, sys, io, json, time, random, asyncio, argparse, hmac, hashlib, sqlite3, tempfile, subprocess
+from urllib.parse import urlencode
+
+BENCH_BOT_TOKEN = "bench:token"
+
+DEFAULT_MIX = "summary_day=40,summary_month=15,addmeal=20,aiadd=10,upload=10,subscribe=5"
+
+def parse_args(argv=None):
+    ap = argparse.ArgumentParser(description="Offline load test for fastapi_app")
+    ap.add_argument("--workdir", help="каталог для БД и загрузок (по умолчанию временный)")
+    ap.add_argument("--users", type=int, default=10_000)
+    ap.add_argument("--meals", type=int, default=1_000_000)
+    ap.add_argument("--days", type=int, default=365, help="на сколько дней назад раскидать сидированные приёмы пищи")
+    ap.add_argument("--concurrency", type=int, default=32)
+    ap.add_argument("--duration", type=float, default=30.0, help="секунды измеряемой нагрузки")
+    ap.add_argument("--warmup", type=float, default=3.0)
+    ap.add_argument("--mix", default=DEFAULT_MIX, help="веса операций: op=weight,...")
+    ap.add_argument("--ai-latency-ms", type=float, default=800.0, help="задержка фейкового ai_estimate_text")
+    ap.add_argument("--vision-latency-ms", type=float, default=2500.0, help="задержка фейкового ai_vision_parse")
+    ap.add_argument("--tg-latency-ms", type=float, default=200.0, help="задержка фейкового createInvoiceLink")
+    ap.add_argument("--image-side", type=int, default=1600, help="сторона тестового JPEG для /api/upload")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--out", help="файл для JSON-результата (по умолчанию stdout)")
+    return ap.parse_args(argv)
+
+def init_data_for(tg_id: int) -> str:
+    data = {"auth_date": str(int(time.time())), "user": json.dumps({"id": tg_id})}
+    dcs = "\n".join(sorted(f"{k}={v}" for k, v in data.items()))
+    data["hash"] = hmac.new(hashlib.sha256(BENCH_BOT_TOKEN.encode()).digest(), dcs.encode(), hashlib.sha256).hexdigest()
+    return urlencode(data)
+
+# --- seeding ---
+def seed(path: str, users: int, meals: int, days: int, rnd: random.Random):
+    import db
+    con = sqlite3.connect(path, isolation_level=None)
+    # при CAL_DB_SHARDS>1 приёмы пищи раскладываются по файлам шардов так же, как это делает db.meals_pool
+    n = db.DB_SHARDS
+    shards = [sqlite3.connect(db.shard_path(i, n, path), isolation_level=None) for i in range(n)] if n > 1 else [con]
+    if sum(sc.execute("SELECT COUNT(*) FROM meals").fetchone()[0] for sc in shards) >= meals:
+        for sc in {*shards, con}:
+            sc.close()
+        return False
+    for sc in {*shards, con}:
+        sc.execute("PRAGMA synchronous=OFF")
+        sc.execute("BEGIN")
+    con.execute("DELETE FROM users")
+    for sc in shards:
+        sc.execute("DELETE FROM meals"); sc.execute("DELETE FROM daily_totals")
+    trial_until = "2099-01-01T00:00:00+00:00"
+    access_until = db.access_until_for("trial", trial_until, None)
+    con.executemany("INSERT INTO users (telegram_id, daily_goal, plan, trial_until, access_until) VALUES (?, ?, 'trial', ?, ?)",
+                    ((1_000_000 + i, rnd.choice((1800, 2000, 2200, 2500)), trial_until, access_until) for i in range(users)))
+    now = int(time.time())
+    names = ("овсянка", "кофе с молоком", "гречка с курицей", "салат", "яблоко", "суп", "омлет", "творог")
+
+    def rows(n):
+        for _ in range(n):
+            ts = now - rnd.randrange(days * 86400)
+            yield (1_000_000 + rnd.randrange(users), time.strftime("%Y-%m-%dT%H:%M:%S+00:00", time.gmtime(ts)), ts,
+                   rnd.randrange(50, 900), rnd.choice(names), rnd.choice(names), rnd.randrange(0, 400), "manual")
+    chunk = 100_000
+    sql = ("INSERT INTO meals (telegram_id, ts, ts_epoch, calories, description, item_name, grams, source) "
+           "VALUES (?, ?, ?, ?, ?, ?, ?, ?)")
+    for start in range(0, meals, chunk):
+        if n > 1:
+            parts: list = [[] for _ in range(n)]
+            for r in rows(min(chunk, meals - start)):
+                parts[db.shard_for(r[0], n)].append(r)
+            for sc, part in zip(shards, parts):
+                sc.executemany(sql, part)
+        else:
+            con.executemany(sql, rows(min(chunk, meals - start)))
+    for sc in shards:
+        sc.execute(db.DAILY_TOTALS_REBUILD_SQL, db.DAILY_TOTALS_REBUILD_PARAMS)
+    for sc in {*shards, con}:
+        sc.execute("COMMIT")
+        sc.execute("ANALYZE")
+        sc.close()
+    return True
+
+# --- fakes ---
+def install_fakes(fa, args):
+    async def fake_estimate(text: str) -> dict:
+        await asyncio.sleep(args.ai_latency_ms / 1000)
+        kcal = 100 + len(text) * 7 % 500
+        return {"items": [{"name": text[:200], "grams": 150, "kcal": kcal}], "total_kcal": kcal}
+
+    async def fake_vision(image_b64: str, prompt: str, fallback: bool = True, path: str = "vision") -> dict:
+        await asyncio.sleep(args.vision_latency_ms / 1000)
+        return {"items": [{"name": "гречка", "grams": 200, "kcal": 220}, {"name": "котлета", "grams": 120, "kcal": 260}]}
+
+    async def fake_invoice(payload: str) -> str:
+        await asyncio.sleep(args.tg_latency_ms / 1000)
+        return f"https://t.me/$bench_{payload}"
+
+    fa.ai_estimate_text = fake_estimate
+    fa.ai_vision_parse = fake_vision
+    fa.tg_create_invoice_link = fake_invoice
+
+def make_image(side: int) -> bytes:
+    try:
+        from PIL import Image
+    except ImportError:
+        return b"\xff\xd8\xff\xe0" + os.urandom(side * side // 8)
+    im = Image.effect_noise((side, side * 3 // 4), 64).convert("RGB")
+    buf = io.BytesIO(); im.save(buf, "JPEG", quality=90)
+    return buf.getvalue()
+
+# --- load ---
+def percentile(sorted_vals: list, p: float) -> float:
+    if not sorted_vals:
+        return 0.0
+    k = min(len(sorted_vals) - 1, max(0, int(round(p / 100 * (len(sorted_vals) - 1)))))
+    return sorted_vals[k]
+
+async def run_load(fa, args, rnd: random.Random) -> dict:
+    import httpx
+    mix = []
+    for part in args.mix.split(","):
+        op, w = part.split("=")
+        mix.append((op.strip(), float(w)))
+    ops, weights = [m[0] for m in mix], [m[1] for m in mix]
+    image = make_image(args.image_side)
+    headers = [{"X-Telegram-Init-Data": init_data_for(1_000_000 + i)} for i in range(min(args.users, 5000))]
+    texts = ["овсянка 200г", "кофе с молоком", "гречка с курицей 300г", "яблоко", "борщ тарелка", "сырники 3 шт"]
+
+    async def call(client, op: str, h: dict):
+        if op == "summary_day":
+            return await client.get("/api/summary?period=day", headers=h)
+        if op == "summary_month":
+            return await client.get("/api/summary?period=month", headers=h)
+        if op == "addmeal":
+            return await client.post("/api/addmeal", json={"calories": rnd.randrange(50, 800), "description": "bench"}, headers=h)
+        if op == "aiadd":
+            return await client.post("/api/aiadd", json={"text": rnd.choice(texts)}, headers=h)
+        if op == "upload":
+            # уникальный хвост — чтобы каждый запрос шёл мимо кэша vision по содержимому
+            body = image + os.urandom(16)
+            return await client.post("/api/upload", data={"type": "photo"}, files={"file": ("bench.jpg", body, "image/jpeg")}, headers=h)
+        if op == "subscribe":
+            return await client.post("/api/subscribe/create", headers=h)
+        raise ValueError(f"unknown op {op}")
+
+    lat: dict = {op: [] for op in ops}
+    errors: dict = {op: {} for op in ops}
+    measuring = False
+    stop_at = time.perf_counter() + args.warmup + args.duration
+
+    async def worker(client):
+        while time.perf_counter() < stop_at:
+            op = rnd.choices(ops, weights)[0]
+            h = rnd.choice(headers)
+            t0 = time.perf_counter()
+            try:
+                r = await call(client, op, h)
+                status = r.status_code
+            except Exception as e:
+                status = type(e).__name__
+            dt = time.perf_counter() - t0
+            if not measuring:
+                continue
+            if status == 200:
+                lat[op].append(dt)
+            else:
+                errors[op][str(status)] = errors[op].get(str(status), 0) + 1
+
+    transport = httpx.ASGITransport(app=fa.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=120) as client:
+        tasks = [asyncio.ensure_future(worker(client)) for _ in range(args.concurrency)]
+        await asyncio.sleep(args.warmup)
+        measuring = True
+        t_start = time.perf_counter()
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - t_start
+
+    result = {"elapsed_s": round(elapsed, 3), "ops": {}}
+    total = 0
+    for op in ops:
+        vals = sorted(lat[op]); total += len(vals)
+        result["ops"][op] = {
+            "count": len(vals),
+            "rps": round(len(vals) / elapsed, 2) if elapsed else 0.0,
+            "p50_ms": round(percentile(vals, 50) * 1000, 2),
+            "p95_ms": round(percentile(vals, 95) * 1000, 2),
+            "p99_ms": round(percentile(vals, 99) * 1000, 2),
+            "max_ms": round(vals[-1] * 1000, 2) if vals else 0.0,
+            "errors": errors[op],
+        }
+    result["total_rps"] = round(total / elapsed, 2) if elapsed else 0.0
+    return result
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return ""
+
+async def main_async(args) -> dict:
+    import fastapi_app as fa
+    install_fakes(fa, args)
+    rnd = random.Random(args.seed)
+    await fa.on_start()
+    try:
+        t0 = time.perf_counter()
+        seeded = await asyncio.to_thread(seed, fa.DB_PATH, args.users, args.meals, args.days, rnd)
+        seed_s = time.perf_counter() - t0
+        load = await run_load(fa, args, rnd)
+    finally:
+        await fa.on_stop()
+    return {"commit": git_commit(), "started_at": int(time.time()),
+            "params": {k: v for k, v in vars(args).items() if k not in ("out", "workdir")},
+            "seed": {"seeded": seeded, "seconds": round(seed_s, 2)}, **load}
+
+def main(argv=None):
+    args = parse_args(argv)
+    workdir = args.workdir or tempfile.mkdtemp(prefix="calbench-")
+    # конфигурация fastapi_app/db читается при импорте — выставляем окружение до него
+    os.environ["CAL_DB_PATH"] = os.path.join(workdir, "calories_bot.db")
+    os.environ["UPLOAD_DIR"] = os.path.join(workdir, "uploads")
+    os.environ["BOT_TOKEN"] = BENCH_BOT_TOKEN
+    os.environ["REQUIRE_AUTH"] = "true"
+    os.environ.pop("OPENAI_API_KEY", None)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    result = asyncio.run(main_async(args))
+    out = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(out + "\n")
+    else:
+        print(out)
+
+if __name__ == "__main__":
+    main()
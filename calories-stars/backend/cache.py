@@ -0,0 +1,116 @@
+# cache.py — in-process кэши: LRU с TTL и single-flight для одинаковых одновременных вызовов
+import os, time, asyncio
+from collections import OrderedDict
+
+_MISSING = object()
+
+class TTLCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._d: "OrderedDict[object, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        item = self._d.get(key, _MISSING)
+        if item is _MISSING:
+            self.misses += 1
+            return default
+        value, expires = item
+        if expires < time.monotonic():
+            del self._d[key]
+            self.misses += 1
+            return default
+        self._d.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl: float = None):
+        self._d[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+        self._d.move_to_end(key)
+        while len(self._d) > self.maxsize:
+            self._d.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self._d.pop(key, _MISSING)
+        return default if item is _MISSING else item[0]
+
+    def clear(self):
+        self._d.clear()
+
+    def __len__(self):
+        return len(self._d)
+
+    def stats(self) -> dict:
+        return {"size": len(self._d), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses}
+
+class SingleFlight:
+    # первый вызов по ключу выполняет fn, остальные ждут тот же результат
+    def __init__(self):
+        self._inflight: dict = {}
+        self.joined = 0
+
+    async def do(self, key, fn):
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._inflight.pop(key) if self._inflight.get(key) is t else None)
+        else:
+            self.joined += 1
+        # shield: отмена одного ожидающего не отменяет общий вызов
+        return await asyncio.shield(task)
+
+    def __len__(self):
+        return len(self._inflight)
+
+# --- per-user response cache ---
+# Готовые тела JSON-ответов по (telegram_id, ключ) с ETag и версией данных пользователя (db.data_version).
+# Кэш живёт в процессе, а версия — в SQLite: запись с другой версией не отдаётся, так что изменения из другого
+# воркера API или бота в режиме polling видны сразу. invalidate(tg_id) лишь освобождает память в этом процессе.
+RESPONSE_CACHE_USERS = int(os.getenv("RESPONSE_CACHE_USERS", "10000"))
+RESPONSE_CACHE_TTL_S = float(os.getenv("RESPONSE_CACHE_TTL_S", "60"))
+
+class UserResponseCache:
+    def __init__(self, maxusers: int, ttl: float):
+        self.ttl = ttl
+        self._users = TTLCache(maxusers, ttl)
+
+    def get(self, tg_id: int, key: str, version: int = 0):
+        entries = self._users.get(tg_id)
+        if not entries:
+            return None
+        item = entries.get(key)
+        if item is None or item[2] < time.monotonic() or item[3] != version:
+            return None
+        return item[0], item[1]
+
+    def set(self, tg_id: int, key: str, etag: str, body: bytes, version: int = 0):
+        entries = self._users.get(tg_id)
+        if entries is None:
+            entries = {}
+        entries[key] = (etag, body, time.monotonic() + self.ttl, version)
+        self._users.set(tg_id, entries)
+
+    def invalidate(self, tg_id: int, prefix: str = ""):
+        if not prefix:
+            self._users.pop(tg_id)
+            return
+        entries = self._users.get(tg_id)
+        if entries:
+            for k in [k for k in entries if k.startswith(prefix)]:
+                del entries[k]
+
+    def stats(self) -> dict:
+        return self._users.stats()
+
+responses = UserResponseCache(RESPONSE_CACHE_USERS, RESPONSE_CACHE_TTL_S)
+
+# --- entitlements ---
+# telegram_id -> users.access_until, только для пользователей с доступом (отказы не кэшируются: после оплаты
+# в другом процессе доступ должен появиться сразу). Истечение срока кэш не ломает — сравнивается с текущим временем.
+ENTITLEMENT_CACHE_SIZE = int(os.getenv("ENTITLEMENT_CACHE_SIZE", "50000"))
+ENTITLEMENT_CACHE_TTL_S = float(os.getenv("ENTITLEMENT_CACHE_TTL_S", "300"))
+
+entitlements = TTLCache(ENTITLEMENT_CACHE_SIZE, ENTITLEMENT_CACHE_TTL_S)
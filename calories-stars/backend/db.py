@@ -0,0 +1,704 @@
+# db.py — общий слой SQLite для API и бота: WAL, настроенные PRAGMA, отдельные соединения на чтение и запись
+import os, glob, time, zlib, asyncio, hashlib
+from datetime import datetime, timezone
+from contextlib import asynccontextmanager
+from typing import Optional
+import aiosqlite
+import metrics
+
+DB_PATH = os.getenv("CAL_DB_PATH", "/var/data/calories_bot.db")
+DB_READERS = int(os.getenv("CAL_DB_READERS", "4"))
+DB_CACHE_KB = int(os.getenv("CAL_DB_CACHE_KB", "16384"))
+DB_MMAP_BYTES = int(os.getenv("CAL_DB_MMAP_BYTES", str(128 * 1024 * 1024)))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("CAL_DB_BUSY_TIMEOUT_MS", "5000"))
+# group commit: 0 — выключен; иначе записи из одновременных запросов копятся столько мс и идут одной транзакцией
+DB_GROUP_COMMIT_MS = float(os.getenv("CAL_DB_GROUP_COMMIT_MS", "0"))
+DB_GROUP_COMMIT_MAX = int(os.getenv("CAL_DB_GROUP_COMMIT_MAX", "128"))
+# synchronous писателя: FULL — COMMIT возвращается только после fsync WAL, подтверждённая запись переживает отключение
+# питания, и group commit делит этот fsync между запросами; NORMAL — быстрее, но последние коммиты могут пропасть
+DB_WRITER_SYNC = os.getenv("CAL_DB_SYNCHRONOUS", "FULL").upper()
+USER_TZ_OFFSET = int(os.getenv("USER_TZ_OFFSET_HOURS", "5"))
+# шардирование meals/daily_totals по telegram_id: 1 — всё в DB_PATH; N>1 — N файлов рядом с ним (reshard_db.py)
+DB_SHARDS = int(os.getenv("CAL_DB_SHARDS", "1"))
+DB_SHARD_READERS = int(os.getenv("CAL_DB_SHARD_READERS", "2"))
+
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",  # читателям fsync не нужен; писателю ставим DB_WRITER_SYNC
+    f"PRAGMA cache_size=-{DB_CACHE_KB}",
+    f"PRAGMA mmap_size={DB_MMAP_BYTES}",
+    f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA foreign_keys=OFF",
+)
+
+# --- statement timing ---
+# Обёртка над aiosqlite.Connection: каждое execute/executemany/execute_fetchall попадает в
+# db_statement_duration_seconds{op,role}. Остальные атрибуты отдаются исходному соединению.
+class _TimedResult:
+    __slots__ = ("_res", "_op", "_role", "_cur")
+
+    def __init__(self, res, op: str, role: str):
+        self._res, self._op, self._role = res, op, role
+
+    async def _run(self):
+        t0 = time.perf_counter()
+        try:
+            return await self._res
+        finally:
+            metrics.db_statement_seconds.observe(time.perf_counter() - t0, self._op, self._role)
+
+    def __await__(self):
+        return self._run().__await__()
+
+    async def __aenter__(self):
+        self._cur = await self._run()
+        return self._cur
+
+    async def __aexit__(self, *exc):
+        await self._cur.close()
+
+class TimedConnection:
+    __slots__ = ("_conn", "role")
+
+    def __init__(self, conn: aiosqlite.Connection, role: str):
+        self._conn, self.role = conn, role
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def execute(self, sql: str, parameters=()):
+        return _TimedResult(self._conn.execute(sql, parameters), metrics.sql_op(sql), self.role)
+
+    def executemany(self, sql: str, parameters):
+        return _TimedResult(self._conn.executemany(sql, parameters), metrics.sql_op(sql) + "_many", self.role)
+
+    async def execute_fetchall(self, sql: str, parameters=()):
+        t0 = time.perf_counter()
+        try:
+            return await self._conn.execute_fetchall(sql, parameters)
+        finally:
+            metrics.db_statement_seconds.observe(time.perf_counter() - t0, metrics.sql_op(sql), self.role)
+
+async def _connect(path: str, readonly: bool) -> TimedConnection:
+    # isolation_level=None: autocommit, транзакции открываем явно через BEGIN IMMEDIATE
+    conn = await aiosqlite.connect(path, isolation_level=None)
+    for p in PRAGMAS:
+        await conn.execute(p)
+    if readonly:
+        await conn.execute("PRAGMA query_only=ON")
+    else:
+        await conn.execute(f"PRAGMA synchronous={DB_WRITER_SYNC}")
+    return TimedConnection(conn, "reader" if readonly else "writer")
+
+# одно соединение-писатель под замком и несколько читателей; в WAL читатели не ждут писателя
+class Pool:
+    def __init__(self, path: str = DB_PATH, readers: int = DB_READERS, group_commit_ms: float = DB_GROUP_COMMIT_MS):
+        self.path = path
+        self.readers = max(1, readers)
+        self.group_commit_ms = group_commit_ms
+        self._wq: "asyncio.Queue[tuple]" = asyncio.Queue()
+        self._gc_task: Optional[asyncio.Task] = None
+        self._writer: Optional[TimedConnection] = None
+        self._wlock = asyncio.Lock()
+        self._rq: "asyncio.Queue[TimedConnection]" = asyncio.Queue()
+        self._all: list = []
+
+    async def open(self):
+        d = os.path.dirname(self.path)
+        if d:
+            os.makedirs(d, exist_ok=True)
+        self._writer = await _connect(self.path, readonly=False)
+        self._all.append(self._writer)
+        for _ in range(self.readers):
+            conn = await _connect(self.path, readonly=True)
+            self._all.append(conn)
+            self._rq.put_nowait(conn)
+        return self
+
+    async def close(self):
+        if self._gc_task is not None:
+            self._gc_task.cancel()
+            try:
+                await self._gc_task
+            except asyncio.CancelledError:
+                pass
+            self._gc_task = None
+        while not self._wq.empty():
+            _, fut = self._wq.get_nowait()
+            if not fut.done():
+                fut.set_exception(RuntimeError("DB pool closed"))
+        if self._writer is not None:
+            try:
+                await self._writer.execute("PRAGMA optimize")
+            except Exception:
+                pass
+        for conn in self._all:
+            await conn.close()
+        self._all.clear()
+        self._writer = None
+
+    @asynccontextmanager
+    async def read(self):
+        t0 = time.perf_counter()
+        conn = await self._rq.get()
+        metrics.db_wait_seconds.observe(time.perf_counter() - t0, "reader")
+        try:
+            yield conn
+        finally:
+            self._rq.put_nowait(conn)
+
+    @asynccontextmanager
+    async def write(self):
+        t0 = time.perf_counter()
+        async with self._wlock:
+            t1 = time.perf_counter()
+            metrics.db_wait_seconds.observe(t1 - t0, "writer")
+            conn = self._writer
+            await conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                await conn.execute("ROLLBACK")
+                raise
+            await conn.execute("COMMIT")
+            metrics.db_transaction_seconds.observe(time.perf_counter() - t1, "write")
+
+    async def run_write(self, fn):
+        # fn(conn) выполняется внутри транзакции записи; результат возвращается только после COMMIT
+        if self.group_commit_ms <= 0:
+            async with self.write() as conn:
+                return await fn(conn)
+        if self._gc_task is None or self._gc_task.done():
+            self._gc_task = asyncio.ensure_future(self._group_commit_loop())
+        fut = asyncio.get_running_loop().create_future()
+        self._wq.put_nowait((fn, fut))
+        return await fut
+
+    async def _group_commit_loop(self):
+        while True:
+            batch = [await self._wq.get()]
+            await asyncio.sleep(self.group_commit_ms / 1000)
+            while len(batch) < DB_GROUP_COMMIT_MAX and not self._wq.empty():
+                batch.append(self._wq.get_nowait())
+            await self._commit_batch([(fn, fut) for fn, fut in batch if not fut.cancelled()])
+
+    async def _commit_batch(self, batch: list):
+        if not batch:
+            return
+        results = []
+        metrics.db_group_commit_size.observe(len(batch))
+        async with self._wlock:
+            t1 = time.perf_counter()
+            conn = self._writer
+            await conn.execute("BEGIN IMMEDIATE")
+            try:
+                for fn, fut in batch:
+                    # savepoint на каждую задачу: ошибка одного запроса не откатывает остальные
+                    await conn.execute("SAVEPOINT gc_item")
+                    try:
+                        res = await fn(conn)
+                    except Exception as e:
+                        await conn.execute("ROLLBACK TO gc_item")
+                        await conn.execute("RELEASE gc_item")
+                        results.append((fut, None, e))
+                    else:
+                        await conn.execute("RELEASE gc_item")
+                        results.append((fut, res, None))
+                await conn.execute("COMMIT")
+                metrics.db_transaction_seconds.observe(time.perf_counter() - t1, "group")
+            except BaseException as e:
+                await conn.execute("ROLLBACK")
+                for _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e if isinstance(e, Exception) else RuntimeError("group commit aborted"))
+                if not isinstance(e, Exception):
+                    raise
+                return
+        for fut, res, err in results:
+            if fut.done():
+                continue
+            if err is not None:
+                fut.set_exception(err)
+            else:
+                fut.set_result(res)
+
+    async def fetchone(self, sql: str, params=()):
+        async with self.read() as conn:
+            async with conn.execute(sql, params) as cur:
+                return await cur.fetchone()
+
+    async def fetchall(self, sql: str, params=()):
+        async with self.read() as conn:
+            async with conn.execute(sql, params) as cur:
+                return await cur.fetchall()
+
+# --- process-wide pool ---
+_pool: Optional[Pool] = None
+_shards: list = []  # пулы шардов meals при DB_SHARDS > 1
+
+async def open_pool(path: str = DB_PATH, readers: int = DB_READERS, shards: int = DB_SHARDS) -> Pool:
+    global _pool
+    if _pool is None:
+        p = await Pool(path, readers).open()
+        try:
+            # и при CAL_DB_SHARDS=1: после reshard --to N запуск без переменной показал бы пустые истории
+            _check_shard_layout(path, shards)
+            if shards > 1 and (await p.fetchone("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'meals'")
+                               and await p.fetchone("SELECT 1 FROM meals LIMIT 1")):
+                raise RuntimeError(f"{os.path.basename(path)} still holds meals; run reshard_db.py first")
+        except Exception:
+            await p.close()
+            raise
+        _pool = p
+        if shards > 1:
+            for i in range(shards):
+                _shards.append(await Pool(shard_path(i, shards, path), DB_SHARD_READERS).open())
+    return _pool
+
+async def close_pool():
+    global _pool
+    for p in _shards:
+        await p.close()
+    _shards.clear()
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+def pool() -> Pool:
+    if _pool is None:
+        raise RuntimeError("DB pool is not open; call open_pool() at startup")
+    return _pool
+
+def read():
+    return pool().read()
+
+def write():
+    return pool().write()
+
+async def run_write(fn):
+    return await pool().run_write(fn)
+
+async def fetchone(sql: str, params=()):
+    return await pool().fetchone(sql, params)
+
+async def fetchall(sql: str, params=()):
+    return await pool().fetchall(sql, params)
+
+# --- meal shards ---
+# meals и daily_totals пользователя живут в одном файле: основном при DB_SHARDS=1, иначе в шарде по хэшу telegram_id.
+# Остальные таблицы (users, payments, jobs, кэши ИИ) — всегда в основном файле. Схема у всех файлов одна
+# (migrate() прогоняет все миграции по каждому), так что вызывающему коду важно только, какой пул взять.
+
+def shard_path(i: int, n: int = DB_SHARDS, base: str = DB_PATH) -> str:
+    # число шардов в имени: после решардинга старые и новые файлы не пересекаются
+    root, ext = os.path.splitext(base)
+    return f"{root}.shard{i:02d}-of-{n:02d}{ext}"
+
+def shard_for(tg_id: int, n: int = DB_SHARDS) -> int:
+    if n <= 1:
+        return 0
+    # стабильный хэш (не hash() — он солится по процессам)
+    return int.from_bytes(hashlib.blake2b(str(tg_id).encode(), digest_size=8).digest(), "big") % n
+
+def meals_pool(tg_id: int) -> Pool:
+    return _shards[shard_for(tg_id, len(_shards))] if _shards else pool()
+
+def meals_pools() -> list:
+    return list(_shards) if _shards else [pool()]
+
+def meals_read(tg_id: int):
+    return meals_pool(tg_id).read()
+
+def _check_shard_layout(path: str, shards: int):
+    # запуск с другим CAL_DB_SHARDS тихо показал бы пустые истории — лучше не стартовать
+    root, ext = os.path.splitext(path)
+    for f in glob.glob(f"{glob.escape(root)}.shard*-of-*{ext}"):
+        if not f.endswith(f"-of-{shards:02d}{ext}") and os.path.getsize(f) > 0:
+            raise RuntimeError(f"found {os.path.basename(f)} but CAL_DB_SHARDS={shards}; "
+                               f"set CAL_DB_SHARDS to match, run reshard_db.py or remove the file")
+
+# --- user data versions ---
+# Счётчик изменений данных пользователя, по строке в каждом файле (основном и шарде пользователя). Поднимается в той же
+# транзакции, что и изменение, поэтому его видят все процессы: кэш ответов в воркере API сверяет версию перед отдачей.
+
+async def bump_version(conn, tg_id: int):
+    await conn.execute("INSERT INTO user_versions (telegram_id, v) VALUES (?, 1) "
+                       "ON CONFLICT(telegram_id) DO UPDATE SET v = v + 1", (tg_id,))
+
+async def data_version(tg_id: int) -> int:
+    # сумма счётчиков основного файла и шарда — тоже только растёт
+    sql = "SELECT v FROM user_versions WHERE telegram_id = ?"
+    row = await fetchone(sql, (tg_id,))
+    v = row[0] if row else 0
+    if _shards:
+        row = await meals_pool(tg_id).fetchone(sql, (tg_id,))
+        v += row[0] if row else 0
+    return v
+
+# --- daily rollups ---
+# daily_totals хранит сумму калорий и число записей по локальной дате (USER_TZ_OFFSET_HOURS).
+# Обновляется в той же транзакции, что и запись/удаление в meals.
+
+def local_day(ts_epoch: int) -> str:
+    return datetime.fromtimestamp(ts_epoch + USER_TZ_OFFSET * 3600, timezone.utc).strftime("%Y-%m-%d")
+
+_DAILY_UPSERT = ("INSERT INTO daily_totals (telegram_id, day, kcal, meals) VALUES (?, ?, ?, ?) "
+                 "ON CONFLICT(telegram_id, day) DO UPDATE SET kcal = kcal + excluded.kcal, meals = meals + excluded.meals")
+
+# полный пересчёт из meals (миграция, сидинг бенчмарка); параметры — смещение пояса в секундах
+DAILY_TOTALS_REBUILD_SQL = ("INSERT INTO daily_totals (telegram_id, day, kcal, meals) "
+                            "SELECT telegram_id, date(ts_epoch + ?, 'unixepoch'), COALESCE(SUM(calories), 0), COUNT(*) "
+                            "FROM meals GROUP BY telegram_id, date(ts_epoch + ?, 'unixepoch')")
+DAILY_TOTALS_REBUILD_PARAMS = (USER_TZ_OFFSET * 3600, USER_TZ_OFFSET * 3600)
+
+async def bump_daily(conn, tg_id: int, ts_epoch: int, kcal: int, meals: int = 1):
+    day = local_day(ts_epoch)
+    await conn.execute(_DAILY_UPSERT, (tg_id, day, kcal, meals))
+    if meals < 0:
+        await conn.execute("DELETE FROM daily_totals WHERE telegram_id = ? AND day = ? AND meals <= 0", (tg_id, day))
+
+# --- meal writes ---
+MEAL_COLUMNS = ("telegram_id", "ts", "ts_epoch", "calories", "description", "item_name", "grams",
+                "source", "photo_url", "payload_id", "local_ts")
+_MEAL_INSERT = (f"INSERT INTO meals ({', '.join(MEAL_COLUMNS)}) "
+                f"VALUES ({', '.join(':' + c for c in MEAL_COLUMNS)})")
+
+async def mark_job_applied(conn, job_id: int) -> bool:
+    # False — задача уже записала свои приёмы пищи (повтор после сбоя)
+    cur = await conn.execute("INSERT OR IGNORE INTO job_applied (job_id, applied_at) VALUES (?, ?)", (job_id, int(time.time())))
+    return cur.rowcount == 1
+
+# --- AI payloads ---
+# Ответ модели хранится один раз на распознавание (ai_payloads, zlib), позиции meals ссылаются на него по payload_id.
+# Одинаковые ответы (повтор фото, кэш vision) схлопываются по sha256 текста.
+PAYLOAD_ZLIB_LEVEL = 6
+
+async def store_payload(conn, raw: str) -> int:
+    data = raw.encode()
+    sha = hashlib.sha256(data).digest()
+    now = int(time.time())
+    # created_at обновляется при повторном использовании — ретенция считает от последней ссылки
+    await conn.execute("INSERT INTO ai_payloads (sha, data, created_at) VALUES (?, ?, ?) "
+                       "ON CONFLICT(sha) DO UPDATE SET created_at = excluded.created_at",
+                       (sha, zlib.compress(data, PAYLOAD_ZLIB_LEVEL), now))
+    rows = await conn.execute_fetchall("SELECT id FROM ai_payloads WHERE sha = ?", (sha,))
+    return rows[0][0]
+
+async def prune_payloads(conn, before: int) -> int:
+    # ответы старше before отвязываются от meals и удаляются вместе с осиротевшими (удалённые приёмы пищи)
+    await conn.execute("UPDATE meals SET payload_id = NULL WHERE payload_id IN (SELECT id FROM ai_payloads WHERE created_at < ?)",
+                       (before,))
+    cur = await conn.execute("DELETE FROM ai_payloads WHERE created_at < ? OR id NOT IN "
+                             "(SELECT payload_id FROM meals WHERE payload_id IS NOT NULL)", (before,))
+    return cur.rowcount
+
+async def insert_meals(conn, rows: list):
+    # все позиции запроса — один executemany, итоги по дням — один upsert на (пользователь, день)
+    if not rows:
+        return
+    payload_ids: dict = {}
+    for r in rows:
+        raw = r.pop("raw_json", None)
+        if raw and raw not in payload_ids:
+            payload_ids[raw] = await store_payload(conn, raw)
+        r["payload_id"] = payload_ids.get(raw) if raw else None
+    await conn.executemany(_MEAL_INSERT, rows)
+    per_day: dict = {}
+    for r in rows:
+        k = (r["telegram_id"], local_day(r["ts_epoch"]))
+        kcal, n = per_day.get(k, (0, 0))
+        per_day[k] = (kcal + int(r["calories"] or 0), n + 1)
+    await conn.executemany(_DAILY_UPSERT, [(tg, day, kcal, n) for (tg, day), (kcal, n) in per_day.items()])
+    for tg in {tg for tg, _ in per_day}:
+        await bump_version(conn, tg)
+
+# --- entitlements ---
+# users.access_until — момент (unix), до которого у пользователя есть доступ; 0 — доступа нет.
+# Пересчитывается при каждом изменении plan/trial_until/renews_at, проверка доступа — сравнение чисел.
+ACCESS_FOREVER = 2 ** 62
+
+def access_until_for(plan: Optional[str], trial_until: Optional[str], renews_at: Optional[str]) -> int:
+    from dateutil.parser import isoparse
+    # те же правила, что были в check_access: pro без даты и нечитаемые даты — доступ без срока
+    if plan == "pro":
+        ts = renews_at
+        if not ts:
+            return ACCESS_FOREVER
+    elif plan == "trial":
+        ts = trial_until
+        if not ts:
+            return 0
+    else:
+        return 0
+    try:
+        dt = isoparse(ts)
+    except Exception:
+        return ACCESS_FOREVER
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp())
+
+async def refresh_access(conn, tg_id: int) -> int:
+    rows = await conn.execute_fetchall("SELECT plan, trial_until, renews_at FROM users WHERE telegram_id = ?", (tg_id,))
+    until = access_until_for(*rows[0]) if rows else 0
+    await conn.execute("UPDATE users SET access_until = ? WHERE telegram_id = ?", (until, tg_id))
+    await bump_version(conn, tg_id)
+    return until
+
+# --- schema migrations ---
+# Каждый шаг выполняется в своей транзакции записи и фиксируется в schema_version. Перенос больших объёмов данных
+# вынесен в MIGRATION_BACKFILLS: он идёт порциями в отдельных транзакциях, версия фиксируется после последней.
+# Новые шаги только добавляются в конец списка, уже выпущенные не меняются.
+
+async def _columns(conn, table: str) -> set:
+    rows = await conn.execute_fetchall(f"PRAGMA table_info({table})")
+    return {r[1] for r in rows}
+
+async def _m001_base(conn):
+    await conn.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        telegram_id INTEGER UNIQUE,
+        daily_goal INTEGER DEFAULT 2000,
+        plan TEXT DEFAULT 'trial',
+        trial_until TEXT,
+        renews_at TEXT,
+        stars_payer_id TEXT,
+        payments_provider TEXT
+    );""")
+    await conn.execute("""
+    CREATE TABLE IF NOT EXISTS meals (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        telegram_id INTEGER,
+        ts TEXT,
+        calories INTEGER,
+        description TEXT,
+        item_name TEXT,
+        grams INTEGER,
+        source TEXT DEFAULT 'manual',
+        photo_url TEXT,
+        raw_json TEXT,
+        local_ts TEXT,
+        FOREIGN KEY (telegram_id) REFERENCES users(telegram_id)
+    );""")
+    await conn.execute("""
+    CREATE TABLE IF NOT EXISTS payments (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        telegram_id INTEGER,
+        created_at TEXT,
+        provider TEXT,
+        amount_cents INTEGER,
+        currency TEXT,
+        period_months INTEGER,
+        status TEXT,
+        provider_payload TEXT
+    );""")
+
+def _iso_to_epoch(ts) -> int:
+    from dateutil.parser import isoparse
+    try:
+        dt = isoparse(ts)
+    except Exception:
+        return 0
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp())
+
+async def _m002_meals_epoch_and_indexes(conn):
+    if "ts_epoch" not in await _columns(conn, "meals"):
+        await conn.execute("ALTER TABLE meals ADD COLUMN ts_epoch INTEGER")
+    # strftime('%s') понимает ISO-строки с дробными секундами и смещением; остальное добиваем в Python
+    await conn.execute("UPDATE meals SET ts_epoch = CAST(strftime('%s', ts) AS INTEGER) WHERE ts_epoch IS NULL")
+    rows = await conn.execute_fetchall("SELECT id, ts FROM meals WHERE ts_epoch IS NULL")
+    if rows:
+        await conn.executemany("UPDATE meals SET ts_epoch = ? WHERE id = ?", [(_iso_to_epoch(ts), rid) for rid, ts in rows])
+    # покрывающие индексы: выборки за день/месяц и профиль не трогают саму таблицу
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_meals_user_ts ON meals(telegram_id, ts_epoch, calories)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_profile ON users(telegram_id, daily_goal, plan, trial_until, renews_at)")
+
+async def _m003_daily_totals(conn):
+    await conn.execute("""
+    CREATE TABLE IF NOT EXISTS daily_totals (
+        telegram_id INTEGER NOT NULL,
+        day TEXT NOT NULL,
+        kcal INTEGER NOT NULL DEFAULT 0,
+        meals INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (telegram_id, day)
+    ) WITHOUT ROWID;""")
+    await conn.execute("DELETE FROM daily_totals")
+    await conn.execute(DAILY_TOTALS_REBUILD_SQL, DAILY_TOTALS_REBUILD_PARAMS)
+
+async def _m004_ai_text_cache(conn):
+    await conn.execute("""
+    CREATE TABLE IF NOT EXISTS ai_text_cache (
+        key TEXT PRIMARY KEY,
+        data TEXT NOT NULL,
+        created_at INTEGER NOT NULL
+    ) WITHOUT ROWID;""")
+
+async def _m005_vision_cache(conn):
+    await conn.execute("""
+    CREATE TABLE IF NOT EXISTS vision_cache (
+        sha TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        data TEXT NOT NULL,
+        created_at INTEGER NOT NULL,
+        PRIMARY KEY (sha, kind)
+    ) WITHOUT ROWID;""")
+
+async def _m006_jobs(conn):
+    await conn.execute("""
+    CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        telegram_id INTEGER NOT NULL,
+        kind TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'queued',
+        payload TEXT NOT NULL,
+        result TEXT,
+        error TEXT,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        run_after INTEGER NOT NULL DEFAULT 0,
+        worker TEXT,
+        lease_until INTEGER,
+        created_at INTEGER NOT NULL,
+        updated_at INTEGER NOT NULL
+    );""")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, run_after, id)")
+
+async def _m007_access_until(conn):
+    if "access_until" not in await _columns(conn, "users"):
+        await conn.execute("ALTER TABLE users ADD COLUMN access_until INTEGER NOT NULL DEFAULT 0")
+    rows = await conn.execute_fetchall("SELECT telegram_id, plan, trial_until, renews_at FROM users")
+    await conn.executemany("UPDATE users SET access_until = ? WHERE telegram_id = ?",
+                           [(access_until_for(plan, tu, ra), tid) for tid, plan, tu, ra in rows])
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_users_access_until ON users(access_until)")
+
+async def _m008_job_applied(conn):
+    # отметка «приёмы пищи задачи уже записаны» — в том же файле и транзакции, что и сами meals
+    await conn.execute("CREATE TABLE IF NOT EXISTS job_applied (job_id INTEGER PRIMARY KEY, applied_at INTEGER NOT NULL)")
+
+async def _m009_ai_payloads(conn):
+    await conn.execute("""
+    CREATE TABLE IF NOT EXISTS ai_payloads (
+        id INTEGER PRIMARY KEY,
+        sha BLOB NOT NULL UNIQUE,
+        data BLOB NOT NULL,
+        created_at INTEGER NOT NULL
+    );""")
+    if "payload_id" not in await _columns(conn, "meals"):
+        await conn.execute("ALTER TABLE meals ADD COLUMN payload_id INTEGER")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_meals_payload ON meals(payload_id) WHERE payload_id IS NOT NULL")
+
+async def _m009_backfill_payloads(p: "Pool"):
+    # переносим raw_json порциями, каждая в своей транзакции: иначе WAL держит копию всех переписанных страниц
+    # до одного COMMIT, и на маленьком диске миграция упирается в SQLITE_FULL. Повтор после сбоя безопасен:
+    # перенесённые строки отсеивает raw_json IS NOT NULL, ответы вставляются по sha с OR IGNORE.
+    # Одинаковые ответы (все позиции одного чека) становятся одной строкой ai_payloads
+    by_text: dict = {}
+    last_id = 0
+    while True:
+        async with p.write() as conn:
+            rows = await conn.execute_fetchall("SELECT id, raw_json, ts_epoch FROM meals WHERE id > ? AND raw_json IS NOT NULL "
+                                               "ORDER BY id LIMIT 5000", (last_id,))
+            if not rows:
+                break
+            updates = []
+            for mid, raw, ts_epoch in rows:
+                pid = by_text.get(raw)
+                if pid is None:
+                    data = raw.encode()
+                    sha = hashlib.sha256(data).digest()
+                    await conn.execute("INSERT OR IGNORE INTO ai_payloads (sha, data, created_at) VALUES (?, ?, ?)",
+                                       (sha, zlib.compress(data, PAYLOAD_ZLIB_LEVEL), int(ts_epoch or time.time())))
+                    pid = by_text[raw] = (await conn.execute_fetchall("SELECT id FROM ai_payloads WHERE sha = ?", (sha,)))[0][0]
+                updates.append((pid, mid))
+            await conn.executemany("UPDATE meals SET payload_id = ?, raw_json = NULL WHERE id = ?", updates)
+        last_id = rows[-1][0]
+        # соседние строки одного ответа идут подряд — словарь держим небольшим
+        if len(by_text) > 10000:
+            by_text.clear()
+
+async def _m010_meals_keyset_index(conn):
+    # keyset-выгрузка идёт по (telegram_id, ts_epoch, id): в idx_meals_user_ts третьим стоит calories, и каждая порция
+    # досортировывалась во временном B-дереве; здесь после ts_epoch неявно идёт rowid = id, поиск сразу с ключа
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_meals_user_ts_id ON meals(telegram_id, ts_epoch)")
+    # старый индекс покрывал сумму калорий за месяц, но месяц давно считается по daily_totals; день и выгрузка идут
+    # по новому — старый остался бы лишней работой на каждой вставке
+    await conn.execute("DROP INDEX IF EXISTS idx_meals_user_ts")
+
+async def _m011_user_versions(conn):
+    await conn.execute("CREATE TABLE IF NOT EXISTS user_versions (telegram_id INTEGER PRIMARY KEY, v INTEGER NOT NULL) WITHOUT ROWID")
+
+async def _m012_payments_charge_id(conn):
+    # id платежа Telegram отдельной колонкой с уникальным индексом: повторная доставка successful_payment
+    # отсекается вставкой (ON CONFLICT DO NOTHING), без поиска по JSON. Из старых дублей id получает первый
+    if "charge_id" not in await _columns(conn, "payments"):
+        await conn.execute("ALTER TABLE payments ADD COLUMN charge_id TEXT")
+    await conn.execute("""
+    UPDATE payments SET charge_id = json_extract(provider_payload, '$.telegram_payment_charge_id')
+    WHERE provider = 'stars' AND charge_id IS NULL AND json_valid(provider_payload) AND id IN (
+        SELECT MIN(id) FROM payments WHERE provider = 'stars' AND json_valid(provider_payload)
+        GROUP BY json_extract(provider_payload, '$.telegram_payment_charge_id'))""")
+    await conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_payments_charge_id ON payments(charge_id)")
+
+async def _m013_job_claim(conn):
+    if "claim" not in await _columns(conn, "jobs"):
+        await conn.execute("ALTER TABLE jobs ADD COLUMN claim TEXT")
+
+async def _m014_drop_users_profile_index(conn):
+    # idx_users_profile из шага 2 перестал покрывать профиль, когда db_get_user стал читать access_until; поиск по
+    # telegram_id и так идёт по UNIQUE-автоиндексу, а лишний индекс — ещё одна запись на каждое изменение users
+    await conn.execute("DROP INDEX IF EXISTS idx_users_profile")
+
+MIGRATIONS = [
+    (1, _m001_base),
+    (2, _m002_meals_epoch_and_indexes),
+    (3, _m003_daily_totals),
+    (4, _m004_ai_text_cache),
+    (5, _m005_vision_cache),
+    (6, _m006_jobs),
+    (7, _m007_access_until),
+    (8, _m008_job_applied),
+    (9, _m009_ai_payloads),
+    (10, _m010_meals_keyset_index),
+    (11, _m011_user_versions),
+    (12, _m012_payments_charge_id),
+    (13, _m013_job_claim),
+    (14, _m014_drop_users_profile_index),
+]
+MIGRATION_BACKFILLS = {9: _m009_backfill_payloads}
+
+async def migrate(p: Optional[Pool] = None) -> int:
+    if p is None:
+        version = await migrate(pool())
+        for sp in _shards:
+            await migrate(sp)
+        return version
+    async with p.write() as conn:
+        await conn.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, applied_at TEXT)")
+    version, applied = 0, False
+    for v, step in MIGRATIONS:
+        backfill = MIGRATION_BACKFILLS.get(v)
+        async with p.write() as conn:
+            # версию перечитываем под замком записи: API и бот могут стартовать одновременно
+            rows = await conn.execute_fetchall("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+            if rows[0][0] >= v:
+                version = rows[0][0]
+                continue
+            await step(conn)
+            if backfill is None:
+                await conn.execute("INSERT INTO schema_version (version, applied_at) VALUES (?, ?)",
+                                   (v, datetime.now(timezone.utc).isoformat()))
+                version, applied = v, True
+                continue
+        # шаг с переносом данных: схема уже закоммичена, данные — порциями; оборвётся — следующий старт продолжит
+        await backfill(p)
+        async with p.write() as conn:
+            await conn.execute("INSERT OR IGNORE INTO schema_version (version, applied_at) VALUES (?, ?)",
+                               (v, datetime.now(timezone.utc).isoformat()))
+        version, applied = v, True
+    if applied:
+        async with p.write() as conn:
+            await conn.execute("ANALYZE")
+    return version
@@ -0,0 +1,122 @@
+# export_meals.py — потоковая выгрузка приёмов пищи в CSV/NDJSON (API /api/meals/export и CLI)
+#
+#   python export_meals.py --user 123456 --from 2025-01-01 --format ndjson --gzip --out meals.ndjson.gz
+#   python export_meals.py --all --out all.csv
+#
+# Строки читаются порциями по keyset (ts_epoch, id) — каждая порция отдельным коротким чтением из шарда пользователя,
+# без OFFSET и без долгой read-транзакции, поэтому память не зависит от объёма истории.
+import os, sys, io, csv, json, zlib, asyncio, argparse
+from datetime import date, datetime, timedelta, timezone
+from typing import Optional
+import db
+
+EXPORT_CHUNK = int(os.getenv("EXPORT_CHUNK", "2000"))
+EXPORT_COLUMNS = ("id", "telegram_id", "ts", "ts_epoch", "local_ts", "calories", "description", "item_name", "grams",
+                  "source", "photo_url")
+FORMATS = {"csv": "text/csv; charset=utf-8", "ndjson": "application/x-ndjson"}
+
+def day_start_epoch(d: date) -> int:
+    # начало локального дня пользователя (USER_TZ_OFFSET_HOURS) в unix-времени
+    return int(datetime(d.year, d.month, d.day, tzinfo=timezone.utc).timestamp()) - db.USER_TZ_OFFSET * 3600
+
+def epoch_range(d_from: Optional[date], d_to: Optional[date]) -> tuple:
+    # [from, to] включительно по локальным датам; None — без границы
+    lo = day_start_epoch(d_from) if d_from else -(2 ** 62)
+    hi = day_start_epoch(d_to + timedelta(days=1)) if d_to else 2 ** 62
+    return lo, hi
+
+_COLS = ", ".join(EXPORT_COLUMNS)
+
+async def iter_meals(tg_id: Optional[int], ts_from: int, ts_to: int, chunk: int = EXPORT_CHUNK):
+    # tg_id=None — все пользователи по (telegram_id, ts_epoch, id), шард за шардом; оба варианта — поиск по idx_meals_user_ts_id без сортировки
+    if tg_id is not None:
+        p = db.meals_pool(tg_id)
+        sql = (f"SELECT {_COLS} FROM meals WHERE telegram_id = ? AND ts_epoch >= ? AND ts_epoch < ? "
+               f"AND (ts_epoch, id) > (?, ?) ORDER BY ts_epoch, id LIMIT ?")
+        key = (ts_from - 1, 0)
+        while True:
+            rows = await p.fetchall(sql, (tg_id, ts_from, ts_to, *key, chunk))
+            for r in rows:
+                yield r
+            if len(rows) < chunk:
+                return
+            key = (rows[-1][3], rows[-1][0])
+    sql = (f"SELECT {_COLS} FROM meals WHERE (telegram_id, ts_epoch, id) > (?, ?, ?) "
+           f"AND ts_epoch >= ? AND ts_epoch < ? ORDER BY telegram_id, ts_epoch, id LIMIT ?")
+    for p in db.meals_pools():
+        key = (-(2 ** 62), 0, 0)
+        while True:
+            rows = await p.fetchall(sql, (*key, ts_from, ts_to, chunk))
+            for r in rows:
+                yield r
+            if len(rows) < chunk:
+                break
+            key = (rows[-1][1], rows[-1][3], rows[-1][0])
+
+async def encode(rows, fmt: str, gzip: bool = False, flush_rows: int = 500):
+    # async-итератор строк -> async-итератор байтов; буфер сбрасывается каждые flush_rows строк
+    if fmt not in FORMATS:
+        raise ValueError(f"format must be one of {', '.join(FORMATS)}")
+    z = zlib.compressobj(6, zlib.DEFLATED, 31) if gzip else None  # wbits=31 — формат gzip
+    buf = io.StringIO()
+    w = csv.writer(buf) if fmt == "csv" else None
+    if w:
+        w.writerow(EXPORT_COLUMNS)
+    n = 0
+
+    def take() -> bytes:
+        data = buf.getvalue().encode()
+        buf.seek(0); buf.truncate()
+        return z.compress(data) if z else data
+
+    async for r in rows:
+        if w:
+            w.writerow(r)
+        else:
+            buf.write(json.dumps(dict(zip(EXPORT_COLUMNS, r)), ensure_ascii=False))
+            buf.write("\n")
+        n += 1
+        if n % flush_rows == 0:
+            out = take()
+            if out:
+                yield out
+    out = take()
+    if z:
+        out += z.flush()
+    if out:
+        yield out
+
+# --- CLI ---
+def parse_args(argv=None):
+    ap = argparse.ArgumentParser(description="Stream meals to CSV/NDJSON")
+    who = ap.add_mutually_exclusive_group(required=True)
+    who.add_argument("--user", type=int, help="telegram_id пользователя")
+    who.add_argument("--all", action="store_true", help="все пользователи")
+    ap.add_argument("--from", dest="date_from", type=date.fromisoformat, help="YYYY-MM-DD, локальная дата включительно")
+    ap.add_argument("--to", dest="date_to", type=date.fromisoformat, help="YYYY-MM-DD, локальная дата включительно")
+    ap.add_argument("--format", choices=tuple(FORMATS), default="csv")
+    ap.add_argument("--gzip", action="store_true")
+    ap.add_argument("--out", help="файл (по умолчанию stdout)")
+    ap.add_argument("--db", default=db.DB_PATH, help="путь к SQLite (по умолчанию CAL_DB_PATH)")
+    ap.add_argument("--shards", type=int, default=db.DB_SHARDS, help="число шардов meals (по умолчанию CAL_DB_SHARDS)")
+    ap.add_argument("--chunk", type=int, default=EXPORT_CHUNK)
+    return ap.parse_args(argv)
+
+async def main_async(args):
+    await db.open_pool(args.db, readers=1, shards=args.shards)
+    out = open(args.out, "wb") if args.out else sys.stdout.buffer
+    try:
+        lo, hi = epoch_range(args.date_from, args.date_to)
+        rows = iter_meals(None if args.all else args.user, lo, hi, args.chunk)
+        async for part in encode(rows, args.format, args.gzip):
+            out.write(part)
+    finally:
+        if args.out:
+            out.close()
+        await db.close_pool()
+
+def main(argv=None):
+    asyncio.run(main_async(parse_args(argv)))
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,20 @@
-import os, json, hmac, hashlib, base64
+import os, io, re, json, hmac, hashlib, base64, asyncio, random, time, tempfile, socket, unicodedata, logging
 from urllib.parse import parse_qsl
 from typing import Optional
-import aiosqlite
-from datetime import datetime, timezone, timedelta
+from datetime import datetime, date, timezone, timedelta
 from dateutil import parser as dateparser
-from fastapi import FastAPI, HTTPException, Body, Header, UploadFile, File, Form
+from fastapi import FastAPI, HTTPException, Body, Header, UploadFile, File, Form, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
+from fastapi.responses import JSONResponse, StreamingResponse, FileResponse
 from pydantic import BaseModel
 import httpx
+import db
+import metrics
+import export_meals
+from cache import TTLCache, SingleFlight, responses, entitlements
 
-DB_PATH = os.getenv("CAL_DB_PATH", "/var/data/calories_bot.db")
+DB_PATH = db.DB_PATH
 USER_TZ_OFFSET = int(os.getenv("USER_TZ_OFFSET_HOURS", "5"))
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
 BOT_TOKEN = os.getenv("BOT_TOKEN", "")
@@ -23,62 +27,128 @@ TELEGRAM_API = f"https://api.telegram.org/bot{BOT_TOKEN}" if BOT_TOKEN else ""
 app = FastAPI(title="Calories WebApp API")
 app.add_middleware(CORSMiddleware, allow_origins=[FRONTEND_ORIGIN] if FRONTEND_ORIGIN!="*" else ["*"],
                    allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
+app.add_middleware(metrics.MetricsMiddleware)
 
 os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
 async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            telegram_id INTEGER UNIQUE,
-            daily_goal INTEGER DEFAULT 2000,
-            plan TEXT DEFAULT 'trial',
-            trial_until TEXT,
-            renews_at TEXT,
-            stars_payer_id TEXT,
-            payments_provider TEXT
-        );""")
-        await db.execute("""
-        CREATE TABLE IF NOT EXISTS meals (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            telegram_id INTEGER,
-            ts TEXT,
-            calories INTEGER,
-            description TEXT,
-            item_name TEXT,
-            grams INTEGER,
-            source TEXT DEFAULT 'manual',
-            photo_url TEXT,
-            raw_json TEXT,
-            local_ts TEXT,
-            FOREIGN KEY (telegram_id) REFERENCES users(telegram_id)
-        );""")
-        await db.execute("""
-        CREATE TABLE IF NOT EXISTS payments (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            telegram_id INTEGER,
-            created_at TEXT,
-            provider TEXT,
-            amount_cents INTEGER,
-            currency TEXT,
-            period_months INTEGER,
-            status TEXT,
-            provider_payload TEXT
-        );""")
-        await db.commit()
+    await db.migrate()
+
+_background: list = []  # фоновые задачи процесса, гасятся в on_stop
 
 @app.on_event("startup")
 async def on_start():
+    await db.open_pool(DB_PATH)
     await init_db()
+    if OPENAI_API_KEY:
+        _ai()
+    async with db.write() as conn:
+        await conn.execute("DELETE FROM ai_text_cache WHERE created_at < ?", (int(time.time()) - AI_TEXT_CACHE_DB_TTL_S,))
+    await asyncio.to_thread(_cleanup_upload_tmp)
+    _background.append(asyncio.ensure_future(metrics.watch_event_loop()))
+    await _job_recover()
+    _background.extend(asyncio.ensure_future(_job_worker()) for _ in range(JOB_WORKERS))
+    _background.append(asyncio.ensure_future(_entitlement_sweeper()))
+    _background.append(asyncio.ensure_future(_retention_loop()))
+    if BOT_MODE == "webhook":
+        await _bot_start()
+
+@app.on_event("shutdown")
+async def on_stop():
+    for t in _background:
+        t.cancel()
+    await asyncio.gather(*_background, return_exceptions=True)
+    _background.clear()
+    await _bot_stop()
+    await _ai_close()
+    await db.close_pool()
+
+# --- Telegram bot: webhook внутри API ---
+# BOT_MODE=polling — бот отдельным процессом (python main_ai_bot.py);
+# BOT_MODE=webhook — обработчики main_ai_bot работают здесь же, на общем пуле БД и кэше ответов.
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+BOT_WEBHOOK_URL = os.getenv("BOT_WEBHOOK_URL", "")  # https://<host>/telegram/webhook; если задан — регистрируем при старте
+BOT_WEBHOOK_SECRET = os.getenv("BOT_WEBHOOK_SECRET", "")  # обязателен: без него любой POST выдаст себе оплату
+
+_tg_app = None
+_tg_failed: set = set()  # update_id апдейтов, чей обработчик упал, — вебхук ответит 500
+
+def _bot_should_retry(err: Exception) -> bool:
+    # обработчики main_ai_bot сначала коммитят запись, потом отвечают в Telegram. Не-Telegram ошибка — это сбой
+    # до COMMIT (транзакция откатилась), повтор безопасен. Из ошибок Telegram API повторять есть смысл только
+    # временные; Forbidden (бот заблокирован), BadRequest и прочие при повторе упадут так же
+    from telegram.error import TelegramError, NetworkError, BadRequest, RetryAfter
+    if not isinstance(err, TelegramError):
+        return True
+    return isinstance(err, RetryAfter) or (isinstance(err, NetworkError) and not isinstance(err, BadRequest))
+
+async def _bot_error(update, context):
+    # PTB глотает исключения обработчиков (и исключения из error handler тоже), поэтому отмечаем апдейт здесь,
+    # а ответ 5xx отдаёт сам маршрут — тогда Telegram повторит доставку
+    logging.getLogger("bot").error("update %s failed", getattr(update, "update_id", None), exc_info=context.error)
+    metrics.bot_update_errors.inc(type(context.error).__name__)
+    if update is not None and getattr(update, "update_id", None) is not None and _bot_should_retry(context.error):
+        _tg_failed.add(update.update_id)
+
+async def _bot_start():
+    global _tg_app
+    if not BOT_TOKEN:
+        raise RuntimeError("BOT_TOKEN required when BOT_MODE=webhook")
+    if not BOT_WEBHOOK_SECRET:
+        raise RuntimeError("BOT_WEBHOOK_SECRET required when BOT_MODE=webhook")
+    import main_ai_bot
+    tg_app = main_ai_bot.build_application(webhook=True)
+    tg_app.add_error_handler(_bot_error)
+    await tg_app.initialize()
+    await tg_app.start()
+    if BOT_WEBHOOK_URL:
+        await tg_app.bot.set_webhook(BOT_WEBHOOK_URL, secret_token=BOT_WEBHOOK_SECRET,
+                                     max_connections=main_ai_bot.BOT_CONCURRENT_UPDATES, allowed_updates=["message", "pre_checkout_query"])
+    _tg_app = tg_app
+
+async def _bot_stop():
+    global _tg_app
+    if _tg_app is None:
+        return
+    tg_app, _tg_app = _tg_app, None
+    await tg_app.stop()
+    await tg_app.shutdown()
+
+@app.post("/telegram/webhook")
+async def telegram_webhook(request: Request, x_telegram_bot_api_secret_token: Optional[str] = Header(None)):
+    if _tg_app is None:
+        raise HTTPException(status_code=404, detail="Webhook disabled")
+    if not hmac.compare_digest(x_telegram_bot_api_secret_token or "", BOT_WEBHOOK_SECRET):
+        raise HTTPException(status_code=403, detail="Bad secret token")
+    from telegram import Update
+    update = Update.de_json(await request.json(), _tg_app.bot)
+    # обрабатываем до ответа; update_processor держит семафор на BOT_CONCURRENT_UPDATES — лишние запросы ждут здесь,
+    # не занимая пул БД. Если обработчик упал до COMMIT или на временной ошибке Telegram, _bot_error отмечает апдейт:
+    # отвечаем 500, и Telegram повторит доставку; остальные ошибки только логируются и считаются
+    await _tg_app.update_processor.process_update(update, _tg_app.process_update(update))
+    if update.update_id in _tg_failed:
+        _tg_failed.discard(update.update_id)
+        raise HTTPException(status_code=500, detail="Update handling failed")
+    return {"ok": True}
 
 # static for uploads
-app.mount("/uploads", StaticFiles(directory=UPLOAD_DIR), name="uploads")
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+
+class UploadFiles(StaticFiles):
+    # имя файла — sha256 содержимого: по одному URL всегда одни и те же байты
+    def file_response(self, *args, **kwargs):
+        resp = super().file_response(*args, **kwargs)
+        resp.headers["Cache-Control"] = IMMUTABLE_CACHE
+        return resp
+
+app.mount("/uploads", UploadFiles(directory=UPLOAD_DIR), name="uploads")
 
 # --- time helpers ---
 def now_utc(): return datetime.now(timezone.utc)
 def to_user_tz(dt_utc: datetime): return dt_utc + timedelta(hours=USER_TZ_OFFSET)
+def to_epoch(dt: datetime) -> int: return int(dt.timestamp())
+def epoch_to_user_tz(ts_epoch: int): return to_user_tz(datetime.fromtimestamp(ts_epoch, timezone.utc))
 def day_bounds_utc_for_user(date_obj):
     local_start = datetime(date_obj.year, date_obj.month, date_obj.day)
     utc_start = (local_start - timedelta(hours=USER_TZ_OFFSET)).replace(tzinfo=timezone.utc)
@@ -94,79 +164,139 @@ def month_bounds_utc_for_user(year:int, month:int):
 
 # --- db helpers ---
 async def db_get_user(tg_id:int) -> dict:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT telegram_id, daily_goal, plan, trial_until, renews_at FROM users WHERE telegram_id=?", (tg_id,))
-        row = await cur.fetchone()
-        if not row:
-            return {}
-        return {"telegram_id": row[0], "daily_goal": row[1], "plan": row[2], "trial_until": row[3], "renews_at": row[4]}
-
-async def db_insert_meal(**kwargs):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
-            "INSERT INTO meals (telegram_id, ts, calories, description, item_name, grams, source, photo_url, raw_json, local_ts) "
-            "VALUES (:telegram_id, :ts, :calories, :description, :item_name, :grams, :source, :photo_url, :raw_json, :local_ts)",
-            kwargs
-        )
-        await db.commit()
+    row = await db.fetchone("SELECT telegram_id, daily_goal, plan, trial_until, renews_at, access_until FROM users WHERE telegram_id=?", (tg_id,))
+    if not row:
+        return {}
+    return {"telegram_id": row[0], "daily_goal": row[1], "plan": row[2], "trial_until": row[3], "renews_at": row[4],
+            "access_until": row[5]}
+
+def meal_row(tg_id: int, ts: datetime, calories: int, description: str = "", item_name: str = "", grams: int = 0,
+             source: str = "manual", photo_url: Optional[str] = None, raw_json: Optional[str] = None,
+             local_ts: Optional[str] = None) -> dict:
+    return {"telegram_id": tg_id, "ts": ts.isoformat(), "ts_epoch": to_epoch(ts), "calories": calories,
+            "description": description, "item_name": item_name, "grams": grams, "source": source,
+            "photo_url": photo_url, "raw_json": raw_json, "local_ts": local_ts}
+
+async def db_insert_meals(tg_id: int, rows: list, ensure_user: bool = False, job_id: Optional[int] = None):
+    # users — в основной БД, приёмы пищи — в файле пользователя (db.meals_pool): одна транзакция на запрос
+    # (или общая с соседними запросами при CAL_DB_GROUP_COMMIT_MS>0)
+    if ensure_user and tg_id not in _known_users:
+        async with db.write() as conn:
+            await conn.execute("INSERT OR IGNORE INTO users (telegram_id) VALUES (?)", (tg_id,))
+        _known_users.add(tg_id)
+
+    async def tx(conn):
+        if job_id is not None and not await db.mark_job_applied(conn, job_id):
+            return
+        await db.insert_meals(conn, rows)
+    await db.meals_pool(tg_id).run_write(tx)
 
 # --- access control ---
-def check_access(user: dict) -> bool:
-    from dateutil.parser import isoparse
-    now = now_utc()
-    plan = user.get("plan")
-    if plan == "pro":
-        ra = user.get("renews_at")
-        if not ra:
-            return True
-        try:
-            return now < isoparse(ra)
-        except Exception:
-            return True
-    if plan == "trial":
-        tu = user.get("trial_until")
+async def has_access(tg_id: int) -> bool:
+    # access_until считается при записи (db.refresh_access), здесь только сравнение. Кэшируем только выданный доступ:
+    # отказ всегда перечитывается из БД — оплата через бота в другом процессе не может сбросить наш кэш
+    now = time.time()
+    until = entitlements.get(tg_id)
+    if until is not None and until > now:
+        return True
+    row = await db.fetchone("SELECT access_until FROM users WHERE telegram_id = ?", (tg_id,))
+    until = int(row[0] or 0) if row else 0
+    if until > now:
+        entitlements.set(tg_id, until)
+        return True
+    entitlements.pop(tg_id)
+    return False
+
+ENTITLEMENT_SWEEP_S = float(os.getenv("ENTITLEMENT_SWEEP_S", "300"))
+ENTITLEMENT_EXPIRING_S = int(os.getenv("ENTITLEMENT_EXPIRING_S", str(3 * 86400)))
+
+async def _entitlement_sweeper():
+    # по idx_users_access_until: кто потерял доступ с прошлого прохода и сколько истекает в ближайшие дни
+    last = int(time.time())
+    while True:
+        await asyncio.sleep(ENTITLEMENT_SWEEP_S)
+        now = int(time.time())
         try:
-            return tu and now < isoparse(tu)
+            expired = await db.fetchall("SELECT telegram_id FROM users WHERE access_until > ? AND access_until <= ?", (last, now))
+            for (tid,) in expired:
+                entitlements.pop(tid)
+                responses.invalidate(tid)
+            metrics.entitlements_expired.inc(value=len(expired))
+            (active,) = await db.fetchone("SELECT COUNT(*) FROM users WHERE access_until > ?", (now,))
+            (expiring,) = await db.fetchone("SELECT COUNT(*) FROM users WHERE access_until > ? AND access_until <= ?",
+                                            (now, now + ENTITLEMENT_EXPIRING_S))
+            metrics.entitlements_active.set(value=active)
+            metrics.entitlements_expiring.set(value=expiring)
+            last = now
         except Exception:
-            return True
-    return False
+            pass
 
 # --- initData validation ---
+INIT_DATA_MAX_AGE_S = int(os.getenv("INIT_DATA_MAX_AGE_S", "0"))  # 0 — auth_date не проверяется
+INIT_DATA_CACHE_SIZE = int(os.getenv("INIT_DATA_CACHE_SIZE", "10000"))
+INIT_DATA_CACHE_TTL_S = int(os.getenv("INIT_DATA_CACHE_TTL_S", "3600"))
+
+_init_data_secret = hashlib.sha256(BOT_TOKEN.encode()).digest() if BOT_TOKEN else b""
+# hash -> (initData, telegram_id, истекает_в); кэшируем только успешно проверенные строки
+_init_data_cache = TTLCache(INIT_DATA_CACHE_SIZE, INIT_DATA_CACHE_TTL_S)
+# пользователи, для которых строка в users уже точно есть
+_known_users: set = set()
+
+def _init_data_hash(init_data: str) -> Optional[str]:
+    for part in init_data.split("&"):
+        if part.startswith("hash="):
+            return part[5:]
+    return None
+
 def _check_init_data(init_data: str) -> Optional[int]:
     if not init_data or not BOT_TOKEN:
         return None
+    hash_value = _init_data_hash(init_data)
+    if not hash_value:
+        return None
+    cached = _init_data_cache.get(hash_value)
+    if cached and hmac.compare_digest(cached[0], init_data) and (cached[2] is None or cached[2] > time.time()):
+        return cached[1]
     try:
         data = dict(parse_qsl(init_data, keep_blank_values=True))
-        hash_value = data.pop('hash', None)
+        hash_value = data.pop('hash', None) or ""
         items = sorted([f"{k}={v}" for k,v in data.items()])
         data_check_string = "\n".join(items)
-        secret_key = hashlib.sha256(BOT_TOKEN.encode()).digest()
-        h = hmac.new(secret_key, msg=data_check_string.encode(), digestmod=hashlib.sha256).hexdigest()
-        if h != hash_value:
+        h = hmac.new(_init_data_secret, msg=data_check_string.encode(), digestmod=hashlib.sha256).hexdigest()
+        if not hmac.compare_digest(h, hash_value):
             return None
+        expires = None
+        if INIT_DATA_MAX_AGE_S > 0:
+            expires = int(data.get("auth_date", 0)) + INIT_DATA_MAX_AGE_S
+            if expires <= time.time():
+                return None
         user_json = data.get('user')
         if not user_json:
             return None
         user = json.loads(user_json)
-        return int(user.get('id'))
+        tid = int(user.get('id'))
     except Exception:
         return None
+    ttl = INIT_DATA_CACHE_TTL_S if expires is None else min(INIT_DATA_CACHE_TTL_S, expires - time.time())
+    _init_data_cache.set(hash_value, (init_data, tid, expires), ttl=ttl)
+    return tid
 
 async def _resolve_tg_id(init_data_header: Optional[str]) -> int:
     if REQUIRE_AUTH and not BOT_TOKEN:
         raise HTTPException(status_code=500, detail="BOT_TOKEN required when REQUIRE_AUTH=true")
     if init_data_header:
         tid = _check_init_data(init_data_header)
+        if tid and tid in _known_users:
+            return tid
         if tid:
-            async with aiosqlite.connect(DB_PATH) as db:
-                now = now_utc()
-                trial_until = (now + timedelta(days=7)).isoformat()
-                await db.execute(
-                    "INSERT INTO users (telegram_id, daily_goal, plan, trial_until) VALUES (?, ?, ?, ?) "
+            async with db.write() as conn:
+                trial_until = now_utc() + timedelta(days=7)
+                await conn.execute(
+                    "INSERT INTO users (telegram_id, daily_goal, plan, trial_until, access_until) VALUES (?, ?, ?, ?, ?) "
                     "ON CONFLICT(telegram_id) DO NOTHING",
-                    (tid, 2000, "trial", trial_until)
+                    (tid, 2000, "trial", trial_until.isoformat(), to_epoch(trial_until))
                 )
-                await db.commit()
+            _known_users.add(tid)
             return tid
         if REQUIRE_AUTH:
             raise HTTPException(status_code=401, detail="Invalid initData")
@@ -177,57 +307,147 @@ ESTIMATE_SYSTEM_PROMPT = ("Ты нутрициолог. Разбивай сво
                           "Возвращай JSON:{\"items\":[{\"name\":\"str\",\"grams\":int,\"kcal\":int}],\"total_kcal\":int}.")
 COACH_SYSTEM_PROMPT = ("Ты дружелюбный фитнес-коуч. Дай 3–5 конкретных советов и 2 замены, учитывая цель и недавний рацион.")
 
-async def ai_estimate_text(text: str) -> dict:
-    if not OPENAI_API_KEY:
-        return {"items":[{"name": text[:200], "grams": 0, "kcal": 0}], "total_kcal": 0}
-    from openai import OpenAI
-    client = OpenAI(api_key=OPENAI_API_KEY)
-    resp = client.chat.completions.create(
-        model=os.getenv("OPENAI_MODEL_ESTIMATE","gpt-4.1-mini"),
-        messages=[{"role":"system","content":ESTIMATE_SYSTEM_PROMPT},{"role":"user","content":text}],
-        temperature=0.1
-    )
-    raw = resp.choices[0].message.content.strip()
+OPENAI_MODEL_ESTIMATE = os.getenv("OPENAI_MODEL_ESTIMATE", "gpt-4.1-mini")
+OPENAI_MODEL_VISION = os.getenv("OPENAI_MODEL_VISION", "gpt-4.1-mini")
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "8"))
+OPENAI_MODEL_CONCURRENCY = int(os.getenv("OPENAI_MODEL_CONCURRENCY", "4"))
+OPENAI_TIMEOUT_S = float(os.getenv("OPENAI_TIMEOUT_S", "30"))
+OPENAI_VISION_TIMEOUT_S = float(os.getenv("OPENAI_VISION_TIMEOUT_S", "60"))
+OPENAI_RETRIES = int(os.getenv("OPENAI_RETRIES", "2"))
+
+_ai_client = None
+_ai_sem = asyncio.Semaphore(OPENAI_MAX_CONCURRENCY)
+_ai_model_sems: dict = {}
+
+def _ai():
+    # один AsyncOpenAI на процесс: общий пул HTTP-соединений, ретраи делаем сами
+    global _ai_client
+    if _ai_client is None:
+        from openai import AsyncOpenAI
+        http = httpx.AsyncClient(limits=httpx.Limits(max_connections=OPENAI_MAX_CONCURRENCY * 2,
+                                                     max_keepalive_connections=OPENAI_MAX_CONCURRENCY),
+                                 timeout=httpx.Timeout(OPENAI_TIMEOUT_S, connect=10.0))
+        _ai_client = AsyncOpenAI(api_key=OPENAI_API_KEY, http_client=http, max_retries=0)
+    return _ai_client
+
+async def _ai_close():
+    global _ai_client
+    if _ai_client is not None:
+        await _ai_client.close()
+        _ai_client = None
+
+async def _ai_chat(model: str, messages: list, path: str, timeout: float = OPENAI_TIMEOUT_S) -> str:
+    # path — text / vision / receipt, только для метрик
+    import openai
+    retryable = (openai.APITimeoutError, openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)
+    sem = _ai_model_sems.setdefault(model, asyncio.Semaphore(OPENAI_MODEL_CONCURRENCY))
+    for attempt in range(OPENAI_RETRIES + 1):
+        try:
+            async with _ai_sem, sem:
+                t0 = time.perf_counter()
+                try:
+                    resp = await _ai().chat.completions.create(model=model, messages=messages, temperature=0.1, timeout=timeout)
+                except Exception:
+                    metrics.ai_request_seconds.observe(time.perf_counter() - t0, model, path, "error")
+                    raise
+                metrics.ai_request_seconds.observe(time.perf_counter() - t0, model, path, "ok")
+            if resp.usage is not None:
+                metrics.ai_tokens.inc(model, path, "prompt", value=resp.usage.prompt_tokens or 0)
+                metrics.ai_tokens.inc(model, path, "completion", value=resp.usage.completion_tokens or 0)
+            return (resp.choices[0].message.content or "").strip()
+        except retryable:
+            if attempt == OPENAI_RETRIES:
+                raise HTTPException(status_code=503, detail="AI service unavailable")
+            metrics.ai_retries.inc(model, path)
+            # full jitter, семафоры на время паузы отпущены
+            await asyncio.sleep(random.uniform(0, min(8.0, 0.5 * 2 ** attempt)))
+
+def _parse_ai_json(raw: str) -> Optional[dict]:
+    raw = raw.strip()
     if raw.startswith("```"):
-        raw = raw.strip("`")
+        raw = raw.strip("`").strip()
         if raw.lower().startswith("json"):
             raw = raw[4:].strip()
     try:
         data = json.loads(raw)
+    except Exception:
+        return None
+    return data if isinstance(data, dict) else None
+
+# --- AI text estimate cache: LRU+TTL в памяти -> таблица ai_text_cache -> single-flight вызов модели ---
+AI_TEXT_CACHE_SIZE = int(os.getenv("AI_TEXT_CACHE_SIZE", "5000"))
+AI_TEXT_CACHE_MEM_TTL_S = int(os.getenv("AI_TEXT_CACHE_MEM_TTL_S", str(24 * 3600)))
+AI_TEXT_CACHE_DB_TTL_S = int(os.getenv("AI_TEXT_CACHE_DB_TTL_S", str(30 * 24 * 3600)))
+# версия промпта входит в ключ: правка ESTIMATE_SYSTEM_PROMPT сама инвалидирует кэш
+ESTIMATE_PROMPT_VERSION = hashlib.sha256(ESTIMATE_SYSTEM_PROMPT.encode()).hexdigest()[:12]
+
+_estimate_mem = TTLCache(AI_TEXT_CACHE_SIZE, AI_TEXT_CACHE_MEM_TTL_S)
+_estimate_flight = SingleFlight()
+ai_cache_stats = {"mem_hits": 0, "db_hits": 0, "misses": 0, "ai_calls": 0}
+
+def _normalize_meal_text(text: str) -> str:
+    return " ".join(unicodedata.normalize("NFKC", text).casefold().split())
+
+def _estimate_cache_key(text: str) -> str:
+    base = f"{OPENAI_MODEL_ESTIMATE}\x00{ESTIMATE_PROMPT_VERSION}\x00{_normalize_meal_text(text)}"
+    return hashlib.sha256(base.encode()).hexdigest()
+
+async def _estimate_remote(text: str, key: str) -> Optional[str]:
+    ai_cache_stats["ai_calls"] += 1
+    raw = await _ai_chat(OPENAI_MODEL_ESTIMATE,
+                         [{"role":"system","content":ESTIMATE_SYSTEM_PROMPT},{"role":"user","content":text}], "text")
+    data = _parse_ai_json(raw)
+    if data is None:
+        return None
+    try:
         for it in data.get("items",[]):
             it["name"] = str(it.get("name",""))[:200]
             it["grams"] = int(it.get("grams",0))
             it["kcal"] = int(it.get("kcal",0))
         data["total_kcal"] = int(data.get("total_kcal", sum(i["kcal"] for i in data.get("items",[]))))
-        return data
     except Exception:
-        return {"items":[{"name": text[:200], "grams": 0, "kcal": 0}], "total_kcal": 0}
+        return None
+    payload = json.dumps(data, ensure_ascii=False)
+    # неудачные ответы не кэшируем, удачные — сразу в оба уровня
+    _estimate_mem.set(key, payload)
+    async with db.write() as conn:
+        await conn.execute("INSERT OR REPLACE INTO ai_text_cache (key, data, created_at) VALUES (?, ?, ?)",
+                           (key, payload, int(time.time())))
+    return payload
 
-async def ai_vision_parse(image_b64: str, prompt: str) -> dict:
+async def ai_estimate_text(text: str) -> dict:
+    fallback = {"items":[{"name": text[:200], "grams": 0, "kcal": 0}], "total_kcal": 0}
     if not OPENAI_API_KEY:
-        return {"items":[{"name":"Блюдо","grams":0,"kcal":0}]}
-    from openai import OpenAI
-    client = OpenAI(api_key=OPENAI_API_KEY)
-    res = client.chat.completions.create(
-        model=os.getenv("OPENAI_MODEL_VISION","gpt-4.1-mini"),
-        messages=[
-            {"role":"system","content":"Всегда возвращай только валидный JSON."},
-            {"role":"user","content":[
-                {"type":"text","text":prompt},
-                {"type":"input_image","image_url":{"url": f"data:image/jpeg;base64,{image_b64}"}}
-            ]}
-        ],
-        temperature=0.1
-    )
-    raw = res.choices[0].message.content.strip()
-    if raw.startswith("```"):
-        raw = raw.strip("`")
-        if raw.lower().startswith("json"):
-            raw = raw[4:].strip()
-    try:
-        return json.loads(raw)
-    except Exception:
-        return {"items":[{"name":"Блюдо","grams":0,"kcal":0}]}
+        return fallback
+    key = _estimate_cache_key(text)
+    payload = _estimate_mem.get(key)
+    if payload is not None:
+        ai_cache_stats["mem_hits"] += 1
+        return json.loads(payload)
+    row = await db.fetchone("SELECT data FROM ai_text_cache WHERE key = ? AND created_at >= ?",
+                            (key, int(time.time()) - AI_TEXT_CACHE_DB_TTL_S))
+    if row:
+        ai_cache_stats["db_hits"] += 1
+        _estimate_mem.set(key, row[0])
+        return json.loads(row[0])
+    ai_cache_stats["misses"] += 1
+    payload = await _estimate_flight.do(key, lambda: _estimate_remote(text, key))
+    return json.loads(payload) if payload is not None else fallback
+
+async def ai_vision_parse(image_b64: str, prompt: str, fallback: bool = True, path: str = "vision") -> Optional[dict]:
+    # fallback=False: при неразборчивом ответе вернуть None, чтобы вызывающий не закэшировал заглушку
+    fallback = {"items":[{"name":"Блюдо","grams":0,"kcal":0}]} if fallback else None
+    if not OPENAI_API_KEY:
+        return fallback
+    raw = await _ai_chat(OPENAI_MODEL_VISION, [
+        {"role":"system","content":"Всегда возвращай только валидный JSON."},
+        {"role":"user","content":[
+            {"type":"text","text":prompt},
+            {"type":"input_image","image_url":{"url": f"data:image/jpeg;base64,{image_b64}"}}
+        ]}
+    ], path, timeout=OPENAI_VISION_TIMEOUT_S)
+    data = _parse_ai_json(raw)
+    return data if data is not None else fallback
 
 # --- models ---
 class AddMealReq(BaseModel):
@@ -237,113 +457,568 @@ class AddMealReq(BaseModel):
 class AiAddReq(BaseModel):
     text: str
 
+# --- cached responses ---
+def _etag(body: bytes) -> str:
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+async def cached_json(request: Request, tg_id: int, key: str, build) -> Response:
+    # тело ответа собирается один раз до изменения данных/TTL; совпавший If-None-Match даёт 304 без тела.
+    # Версию читаем до сборки: запись, пришедшая во время сборки, поднимет её, и следующий запрос соберёт заново
+    version = await db.data_version(tg_id)
+    hit = responses.get(tg_id, key, version)
+    if hit is None:
+        body = json.dumps(await build(), ensure_ascii=False, separators=(",", ":")).encode()
+        etag = _etag(body)
+        responses.set(tg_id, key, etag, body, version)
+    else:
+        etag, body = hit
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    inm = request.headers.get("if-none-match")
+    if inm and (inm.strip() == "*" or etag in [t.strip() for t in inm.split(",")]):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
 # --- endpoints ---
+async def _build_profile(tg_id: int) -> dict:
+    row = await db.fetchone("SELECT daily_goal FROM users WHERE telegram_id = ?", (tg_id,))
+    goal = int(row[0]) if row else 2000
+    return {"goal": goal, "tzOffset": USER_TZ_OFFSET}
+
 @app.get("/api/profile")
-async def profile(x_telegram_init_data: Optional[str] = Header(None)):
+async def profile(request: Request, x_telegram_init_data: Optional[str] = Header(None)):
     tg_id = await _resolve_tg_id(x_telegram_init_data)
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT daily_goal FROM users WHERE telegram_id = ?", (tg_id,))
-        row = await cur.fetchone()
-        goal = int(row[0]) if row else 2000
-    return {"goal": goal, "tzOffset": USER_TZ_OFFSET}
+    return await cached_json(request, tg_id, "profile", lambda: _build_profile(tg_id))
 
 @app.get("/api/summary")
-async def summary(period: str = "day", x_telegram_init_data: Optional[str] = Header(None)):
+async def summary(request: Request, period: str = "day", x_telegram_init_data: Optional[str] = Header(None)):
     tg_id = await _resolve_tg_id(x_telegram_init_data)
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("SELECT daily_goal FROM users WHERE telegram_id = ?", (tg_id,))
-        row = await cur.fetchone()
-        goal = int(row[0]) if row else 2000
+    if period not in ("day", "month"):
+        raise HTTPException(status_code=400, detail="period must be 'day' or 'month'")
+    now_local = to_user_tz(now_utc())
+    # локальная дата в ключе: после полуночи кэш сам переключается на новый день/месяц
+    key = f"summary:{period}:{now_local.date().isoformat() if period == 'day' else now_local.strftime('%Y-%m')}"
+    return await cached_json(request, tg_id, key, lambda: _build_summary(tg_id, period))
+
+async def _build_summary(tg_id: int, period: str) -> dict:
+    row = await db.fetchone("SELECT daily_goal FROM users WHERE telegram_id = ?", (tg_id,))
+    goal = int(row[0]) if row else 2000
+    async with db.meals_read(tg_id) as conn:
         if period == "day":
             today = to_user_tz(now_utc()).date()
             s,e = day_bounds_utc_for_user(today)
-            cur = await db.execute("SELECT id, ts, calories, item_name FROM meals WHERE telegram_id = ? AND ts >= ? AND ts < ? ORDER BY ts ASC",
-                                   (tg_id, s.isoformat(), e.isoformat()))
-            rows = await cur.fetchall()
-            total = 0; items=[]
-            for rid, ts, kc, name in rows:
-                total += int(kc)
-                items.append({"id": rid, "time": to_user_tz(dateparser.isoparse(ts)).strftime("%H:%M"), "kcal": int(kc), "item": name or ""})
+            rows = await conn.execute_fetchall("SELECT kcal FROM daily_totals WHERE telegram_id = ? AND day = ?", (tg_id, today.isoformat()))
+            total = int(rows[0][0]) if rows else 0
+            rows = await conn.execute_fetchall("SELECT id, ts_epoch, calories, item_name, photo_url FROM meals WHERE telegram_id = ? AND ts_epoch >= ? AND ts_epoch < ? ORDER BY ts_epoch ASC, id ASC",
+                                               (tg_id, to_epoch(s), to_epoch(e)))
+            items=[]
+            for rid, ts_epoch, kc, name, photo_url in rows:
+                item = {"id": rid, "time": epoch_to_user_tz(ts_epoch).strftime("%H:%M"), "kcal": int(kc), "item": name or ""}
+                if photo_url:
+                    item["thumb"] = media_url(photo_url, "thumb")
+                items.append(item)
             remaining = max(0, goal - total)
             return {"dateISO": today.isoformat(), "total": total, "goal": goal, "remaining": remaining, "items": items}
         elif period == "month":
             now_local = to_user_tz(now_utc())
             s,e,days = month_bounds_utc_for_user(now_local.year, now_local.month)
-            cur = await db.execute("SELECT calories FROM meals WHERE telegram_id = ? AND ts >= ? AND ts < ?",
-                                   (tg_id, s.isoformat(), e.isoformat()))
-            rows = await cur.fetchall()
-            total = sum(int(r[0]) for r in rows)
+            first_day = date(now_local.year, now_local.month, 1)
+            rows = await conn.execute_fetchall("SELECT COALESCE(SUM(kcal), 0) FROM daily_totals WHERE telegram_id = ? AND day >= ? AND day < ?",
+                                               (tg_id, first_day.isoformat(), (first_day + timedelta(days=days)).isoformat()))
+            total = int(rows[0][0])
             avg = total / days if days>0 else 0
             return {"ym": f"{now_local.year}-{str(now_local.month).zfill(2)}", "total": total, "avgPerDay": avg}
-        else:
-            raise HTTPException(status_code=400, detail="period must be 'day' or 'month'")
 
 @app.post("/api/addmeal")
 async def addmeal(req: AddMealReq, x_telegram_init_data: Optional[str] = Header(None)):
     tg_id = await _resolve_tg_id(x_telegram_init_data)
-    ts = now_utc().isoformat()
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("INSERT OR IGNORE INTO users (telegram_id) VALUES (?)", (tg_id,))
-        await db.execute("UPDATE users SET daily_goal = COALESCE(daily_goal, 2000) WHERE telegram_id = ?", (tg_id,))
-        await db.execute("INSERT INTO meals (telegram_id, ts, calories, description, item_name, grams) VALUES (?, ?, ?, ?, ?, ?)",
-                         (tg_id, ts, int(req.calories), req.description or "", req.description or "", 0))
-        await db.commit()
+    await db_insert_meals(tg_id, [meal_row(tg_id, now_utc(), int(req.calories), req.description or "", req.description or "")],
+                          ensure_user=True)
+    responses.invalidate(tg_id, "summary:")
     return {"ok": True}
 
 @app.post("/api/aiadd")
 async def aiadd(req: AiAddReq, x_telegram_init_data: Optional[str] = Header(None)):
     tg_id = await _resolve_tg_id(x_telegram_init_data)
     data = await ai_estimate_text(req.text or "")
-    ts = now_utc().isoformat()
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("INSERT OR IGNORE INTO users (telegram_id) VALUES (?)", (tg_id,))
-        for it in data.get("items", []):
-            await db.execute(
-                "INSERT INTO meals (telegram_id, ts, calories, description, item_name, grams, source, raw_json) "
-                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-                (tg_id, ts, int(it.get("kcal",0)), (req.text or "")[:240], it.get("name",""), int(it.get("grams",0)),
-                 "vision", json.dumps(data, ensure_ascii=False))
-            )
-        await db.commit()
+    now = now_utc()
+    raw = json.dumps(data, ensure_ascii=False)
+    rows = [meal_row(tg_id, now, int(it.get("kcal",0)), (req.text or "")[:240], it.get("name",""), int(it.get("grams",0)),
+                     source="vision", raw_json=raw)
+            for it in data.get("items", [])]
+    await db_insert_meals(tg_id, rows, ensure_user=True)
+    responses.invalidate(tg_id, "summary:")
     return data
 
 @app.delete("/api/meal/{meal_id}")
 async def delete_meal(meal_id: int, x_telegram_init_data: Optional[str] = Header(None)):
     tg_id = await _resolve_tg_id(x_telegram_init_data)
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("DELETE FROM meals WHERE id = ? AND telegram_id = ?", (meal_id, tg_id))
-        await db.commit()
+    async def tx(conn):
+        rows = await conn.execute_fetchall("SELECT ts_epoch, calories FROM meals WHERE id = ? AND telegram_id = ?", (meal_id, tg_id))
+        if rows:
+            await conn.execute("DELETE FROM meals WHERE id = ? AND telegram_id = ?", (meal_id, tg_id))
+            await db.bump_daily(conn, tg_id, rows[0][0], -int(rows[0][1] or 0), -1)
+            await db.bump_version(conn, tg_id)
+    await db.meals_pool(tg_id).run_write(tx)
+    responses.invalidate(tg_id, "summary:")
     return {"ok": True}
 
-# Upload photo
-def save_file_local(content: bytes, filename: str) -> str:
-    fname = f"{datetime.now().timestamp()}_{filename or 'img.jpg'}"
-    path = os.path.join(UPLOAD_DIR, fname)
-    with open(path, "wb") as f:
-        f.write(content)
-    return f"/uploads/{fname}"
+MAX_HISTORY_DAYS = 731
+
+@app.get("/api/history")
+async def history(date_from: Optional[str] = Query(None, alias="from"), date_to: Optional[str] = Query(None, alias="to"),
+                  x_telegram_init_data: Optional[str] = Header(None)):
+    tg_id = await _resolve_tg_id(x_telegram_init_data)
+    try:
+        d_to = date.fromisoformat(date_to) if date_to else to_user_tz(now_utc()).date()
+        d_from = date.fromisoformat(date_from) if date_from else d_to - timedelta(days=6)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="from/to must be YYYY-MM-DD")
+    days = (d_to - d_from).days + 1
+    if days < 1 or days > MAX_HISTORY_DAYS:
+        raise HTTPException(status_code=400, detail=f"range must be 1..{MAX_HISTORY_DAYS} days")
+    row = await db.fetchone("SELECT daily_goal FROM users WHERE telegram_id = ?", (tg_id,))
+    goal = int(row[0]) if row else 2000
+    async with db.meals_read(tg_id) as conn:
+        rows = await conn.execute_fetchall("SELECT day, kcal, meals FROM daily_totals WHERE telegram_id = ? AND day >= ? AND day <= ? ORDER BY day",
+                                           (tg_id, d_from.isoformat(), d_to.isoformat()))
+    by_day = {d: (int(kc), int(n)) for d, kc, n in rows}
+    out = []; total = 0
+    for i in range(days):
+        d = (d_from + timedelta(days=i)).isoformat()
+        kc, n = by_day.get(d, (0, 0))
+        total += kc
+        out.append({"date": d, "total": kc, "meals": n})
+    return {"from": d_from.isoformat(), "to": d_to.isoformat(), "goal": goal, "total": total, "avgPerDay": total / days, "days": out}
+
+# Выгрузка всей истории: свою — по initData, всех пользователей (all=true) — только с EXPORT_ADMIN_TOKEN
+EXPORT_ADMIN_TOKEN = os.getenv("EXPORT_ADMIN_TOKEN", "")
+
+@app.get("/api/meals/export")
+async def meals_export(format: str = "csv", date_from: Optional[str] = Query(None, alias="from"),
+                       date_to: Optional[str] = Query(None, alias="to"), gzip: bool = False, all: bool = False,
+                       authorization: Optional[str] = Header(None), x_telegram_init_data: Optional[str] = Header(None)):
+    if format not in export_meals.FORMATS:
+        raise HTTPException(status_code=400, detail="format must be csv or ndjson")
+    try:
+        d_from = date.fromisoformat(date_from) if date_from else None
+        d_to = date.fromisoformat(date_to) if date_to else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="from/to must be YYYY-MM-DD")
+    if all:
+        if not EXPORT_ADMIN_TOKEN or not hmac.compare_digest(authorization or "", f"Bearer {EXPORT_ADMIN_TOKEN}"):
+            raise HTTPException(status_code=403, detail="admin token required")
+        tg_id, name = None, "meals-all"
+    else:
+        tg_id = await _resolve_tg_id(x_telegram_init_data)
+        name = f"meals-{tg_id}"
+    lo, hi = export_meals.epoch_range(d_from, d_to)
+    filename = f"{name}.{format}" + (".gz" if gzip else "")
+    return StreamingResponse(export_meals.encode(export_meals.iter_meals(tg_id, lo, hi), format, gzip),
+                             media_type="application/gzip" if gzip else export_meals.FORMATS[format],
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"', "Cache-Control": "no-store"})
+
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+def _cache_metrics() -> list:
+    mem = _estimate_mem.stats()
+    resp = responses.stats()
+    return [
+        ("ai_text_cache_events_total", "counter", "AI text estimate cache lookups by outcome",
+         {(("outcome", k),): v for k, v in ai_cache_stats.items()}),
+        ("ai_text_cache_entries", "gauge", "Entries in the in-memory AI text cache", {(): mem["size"]}),
+        ("vision_cache_events_total", "counter", "Vision cache lookups by outcome",
+         {(("outcome", k),): v for k, v in vision_cache_stats.items()}),
+        ("singleflight_joined_total", "counter", "Calls that joined an identical in-flight AI call",
+         {(("cache", "ai_text"),): _estimate_flight.joined, (("cache", "vision"),): _vision_flight.joined}),
+        ("singleflight_inflight", "gauge", "AI calls in flight",
+         {(("cache", "ai_text"),): len(_estimate_flight), (("cache", "vision"),): len(_vision_flight)}),
+        ("response_cache_events_total", "counter", "Per-user response cache lookups by outcome",
+         {(("outcome", "hits"),): resp["hits"], (("outcome", "misses"),): resp["misses"]}),
+        ("response_cache_users", "gauge", "Users with cached responses", {(): resp["size"]}),
+    ]
+
+metrics.register_collector(_cache_metrics)
+
+@app.get("/metrics")
+async def metrics_endpoint(authorization: Optional[str] = Header(None)):
+    if METRICS_TOKEN and not hmac.compare_digest(authorization or "", f"Bearer {METRICS_TOKEN}"):
+        raise HTTPException(status_code=401, detail="metrics token required")
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+# Upload photo: файлы лежат по sha256 содержимого (uploads/ab/abcdef….jpg), одинаковые байты хранятся один раз
+IMAGE_EXTS = {".jpg", ".jpeg", ".png", ".webp", ".heic", ".gif"}
+
+def _image_ext(head: bytes, filename: str) -> str:
+    if head.startswith(b"\xff\xd8\xff"): return ".jpg"
+    if head.startswith(b"\x89PNG"): return ".png"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP": return ".webp"
+    if head[:6] in (b"GIF87a", b"GIF89a"): return ".gif"
+    ext = os.path.splitext(filename or "")[1].lower()
+    return ext if ext in IMAGE_EXTS else ".jpg"
+
+def _upload_relpath(sha: str, ext: str) -> str:
+    return f"{sha[:2]}/{sha}{ext}"
+
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", "7000000"))
+UPLOAD_CHUNK_BYTES = 256 * 1024
+# временные файлы вне /uploads (чтобы не раздавались), но на том же диске — для атомарного os.replace
+UPLOAD_TMP_DIR = os.getenv("UPLOAD_TMP_DIR", os.path.join(os.path.dirname(os.path.abspath(UPLOAD_DIR)), "upload_tmp"))
+os.makedirs(UPLOAD_TMP_DIR, exist_ok=True)
+UPLOAD_FORM_OVERHEAD = 64 * 1024  # заголовки multipart и поля формы сверх самого файла
+
+class UploadLimitMiddleware:
+    # multipart-парсер Starlette пишет всё тело во временный файл до вызова обработчика и лимита не знает,
+    # поэтому режем здесь: по Content-Length — не читая тела, а без него (chunked) — по мере поступления
+    def __init__(self, app, path: str = "/api/upload"):
+        self.app, self.path = app, path
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] != self.path:
+            return await self.app(scope, receive, send)
+        limit = MAX_UPLOAD_BYTES + UPLOAD_FORM_OVERHEAD
+        length = dict(scope["headers"]).get(b"content-length")
+        if length is not None and length.isdigit() and int(length) > limit:
+            resp = JSONResponse(status_code=413, content={"detail": "Image too large"}, headers={"Connection": "close"})
+            return await resp(scope, receive, send)
+        seen = 0
+
+        async def limited_receive():
+            nonlocal seen
+            message = await receive()
+            if message["type"] == "http.request":
+                seen += len(message.get("body", b""))
+                if seen > limit:
+                    # HTTPException из разбора тела FastAPI пробрасывает как есть -> 413
+                    raise HTTPException(status_code=413, detail="Image too large")
+            return message
+        await self.app(scope, limited_receive, send)
+
+app.add_middleware(UploadLimitMiddleware)
+
+async def spool_upload(file: UploadFile) -> tuple:
+    # копируем разобранный файл кусками во временный файл, считая sha256 и размер; размер тела уже ограничен UploadLimitMiddleware
+    fd, tmp = tempfile.mkstemp(dir=UPLOAD_TMP_DIR, suffix=".part")
+    f = os.fdopen(fd, "wb")
+    sha = hashlib.sha256(); size = 0; head = b""
+    try:
+        while True:
+            chunk = await file.read(UPLOAD_CHUNK_BYTES)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > MAX_UPLOAD_BYTES:
+                raise HTTPException(status_code=413, detail="Image too large")
+            if len(head) < 16:
+                head += chunk[:16]
+            sha.update(chunk)
+            await asyncio.to_thread(f.write, chunk)
+    except BaseException:
+        f.close()
+        os.unlink(tmp)
+        raise
+    await asyncio.to_thread(f.close)
+    return tmp, sha.hexdigest(), size, head
+
+def _cleanup_upload_tmp(max_age_s: int = 3600):
+    cutoff = time.time() - max_age_s
+    for name in os.listdir(UPLOAD_TMP_DIR):
+        p = os.path.join(UPLOAD_TMP_DIR, name)
+        try:
+            if os.path.getmtime(p) < cutoff:
+                os.unlink(p)
+        except OSError:
+            pass
+
+def store_spooled(tmp: str, sha: str, head: bytes, filename: str) -> tuple:
+    rel = _upload_relpath(sha, _image_ext(head, filename))
+    path = os.path.join(UPLOAD_DIR, rel)
+    if os.path.exists(path):
+        os.unlink(tmp)
+        os.utime(path)  # свежий mtime: ретенция не удалит файл, на который вот-вот сошлётся новая запись
+    else:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp, path)
+    return f"/uploads/{rel}", path
+
+# --- retention: старые ответы модели и файлы, на которые больше не ссылается ни один приём пищи ---
+AI_PAYLOAD_RETENTION_DAYS = int(os.getenv("AI_PAYLOAD_RETENTION_DAYS", "180"))  # 0 — хранить, пока есть ссылки
+UPLOAD_ORPHAN_GRACE_S = int(os.getenv("UPLOAD_ORPHAN_GRACE_S", "86400"))
+RETENTION_INTERVAL_S = float(os.getenv("RETENTION_INTERVAL_S", "86400"))
+
+def _prune_upload_files(referenced: set) -> tuple:
+    # свежие файлы не трогаем: загрузка уже на диске, а запись в meals/jobs ещё не сделана.
+    # Вместе с оригиналом удаляем его превью в THUMB_DIR; возвращает (оригиналов, превью)
+    cutoff = time.time() - UPLOAD_ORPHAN_GRACE_S
+    removed = thumbs = 0
+    for root, _, files in os.walk(UPLOAD_DIR):
+        for name in files:
+            path = os.path.join(root, name)
+            rel = os.path.relpath(path, UPLOAD_DIR).replace(os.sep, "/")
+            if "/uploads/" + rel in referenced:
+                continue
+            try:
+                if os.path.getmtime(path) >= cutoff:
+                    continue
+                os.unlink(path)
+                removed += 1
+            except FileNotFoundError:
+                continue
+            for size in THUMB_SIZES:
+                try:
+                    os.unlink(_thumb_path(size, rel))
+                    thumbs += 1
+                except FileNotFoundError:
+                    pass
+    return removed, thumbs
+
+async def run_retention() -> dict:
+    before = int(time.time()) - AI_PAYLOAD_RETENTION_DAYS * 86400 if AI_PAYLOAD_RETENTION_DAYS > 0 else 0
+    payloads, referenced = 0, set()
+    for p in db.meals_pools():
+        async with p.write() as conn:
+            payloads += await db.prune_payloads(conn, before)
+        referenced.update(url for (url,) in await p.fetchall("SELECT DISTINCT photo_url FROM meals WHERE photo_url IS NOT NULL"))
+    # vision_cache — та же копия ответа модели по sha фото, срок тот же; порциями, чтобы не держать замок записи
+    vision = 0
+    while before:
+        async with db.write() as conn:
+            cur = await conn.execute("DELETE FROM vision_cache WHERE (sha, kind) IN "
+                                     "(SELECT sha, kind FROM vision_cache WHERE created_at < ? LIMIT 5000)", (before,))
+            n = cur.rowcount
+        vision += n
+        if n < 5000:
+            break
+    for (payload,) in await db.fetchall("SELECT payload FROM jobs WHERE status IN ('queued', 'running')"):
+        referenced.add(json.loads(payload).get("photo_url"))
+    files, thumbs = await asyncio.to_thread(_prune_upload_files, referenced)
+    if thumbs:
+        _thumb_usage[0] = None  # пересчитается при следующей записи превью
+    metrics.retention_removed.inc("ai_payload", value=payloads)
+    metrics.retention_removed.inc("vision_cache", value=vision)
+    metrics.retention_removed.inc("upload_file", value=files)
+    metrics.retention_removed.inc("thumb", value=thumbs)
+    return {"payloads": payloads, "vision_cache": vision, "files": files, "thumbs": thumbs}
+
+async def _retention_loop():
+    while True:
+        await asyncio.sleep(RETENTION_INTERVAL_S)
+        try:
+            await run_retention()
+        except Exception:
+            pass
+
+# --- превью: производные размеры в THUMB_DIR, отдаются через /media/{size}/... с immutable-кэшем ---
+THUMB_DIR = os.getenv("THUMB_DIR", os.path.join(os.path.dirname(os.path.abspath(UPLOAD_DIR)), "upload_thumbs"))
+THUMB_SIZES = {"thumb": 256, "preview": 1024}
+THUMB_JPEG_QUALITY = int(os.getenv("THUMB_JPEG_QUALITY", "80"))
+THUMB_CACHE_MAX_BYTES = int(os.getenv("THUMB_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+THUMB_CONCURRENCY = int(os.getenv("THUMB_CONCURRENCY", "2"))
+THUMB_TOUCH_S = 3600  # mtime превью — отметка LRU; обновляем не чаще раза в час
+MEDIA_FALLBACK_CACHE = "public, max-age=300"  # оригинал вместо несобравшегося превью
+
+_MEDIA_REL = re.compile(r"^[0-9a-f]{2}/[0-9a-f]{64}\.[a-z]{3,4}$")
+_thumb_sem = asyncio.Semaphore(THUMB_CONCURRENCY)
+_thumb_flight = SingleFlight()
+_thumb_usage: list = [None]  # байт в THUMB_DIR; считается при первой записи
+_thumb_tasks: set = set()
+
+def media_url(photo_url: Optional[str], size: str) -> Optional[str]:
+    if not photo_url or not photo_url.startswith("/uploads/"):
+        return photo_url
+    rel = photo_url[len("/uploads/"):]
+    return f"/media/{size}/{rel}" if _MEDIA_REL.match(rel) else photo_url
+
+def _thumb_path(size: str, rel: str) -> str:
+    return os.path.join(THUMB_DIR, size, os.path.splitext(rel)[0] + ".jpg")
+
+def make_thumb(src: str, dst: str, side: int) -> int:
+    from PIL import Image, ImageOps
+    with Image.open(src) as im:
+        im = ImageOps.exif_transpose(im)
+        if im.mode != "RGB":
+            im = im.convert("RGB")
+        im.thumbnail((side, side), Image.LANCZOS)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(dst), suffix=".part")
+        with os.fdopen(fd, "wb") as f:
+            im.save(f, "JPEG", quality=THUMB_JPEG_QUALITY, optimize=True, progressive=True)
+    os.replace(tmp, dst)
+    return os.path.getsize(dst)
+
+def _thumb_scan() -> int:
+    total = 0
+    for root, _, files in os.walk(THUMB_DIR):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except FileNotFoundError:
+                pass
+    return total
+
+def _thumb_evict(keep: str) -> int:
+    # LRU по mtime: удаляем самые давние, пока не останется 90% лимита; keep — только что созданное превью
+    entries = []
+    for root, _, files in os.walk(THUMB_DIR):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+    total = sum(e[1] for e in entries)
+    entries.sort()
+    for _, size, path in entries:
+        if total <= THUMB_CACHE_MAX_BYTES * 0.9:
+            break
+        if path == keep:
+            continue
+        try:
+            os.unlink(path)
+            total -= size
+        except FileNotFoundError:
+            pass
+    return total
+
+async def ensure_thumb(size: str, rel: str) -> Optional[str]:
+    dst = _thumb_path(size, rel)
+    if os.path.exists(dst):
+        return dst
+
+    async def build():
+        async with _thumb_sem:
+            if os.path.exists(dst):
+                return dst
+            try:
+                n = await asyncio.to_thread(make_thumb, os.path.join(UPLOAD_DIR, rel), dst, THUMB_SIZES[size])
+            except Exception:
+                return None  # нет Pillow или битый файл — отдадим оригинал
+            if _thumb_usage[0] is None:
+                _thumb_usage[0] = await asyncio.to_thread(_thumb_scan)
+            else:
+                _thumb_usage[0] += n
+            if _thumb_usage[0] > THUMB_CACHE_MAX_BYTES:
+                _thumb_usage[0] = await asyncio.to_thread(_thumb_evict, dst)
+            return dst
+    return await _thumb_flight.do((size, rel), build)
+
+def spawn_thumbs(photo_url: str):
+    # сразу после сохранения, не задерживая ответ; ошибки не важны — размер догенерируется по запросу
+    rel = photo_url[len("/uploads/"):]
+    if not _MEDIA_REL.match(rel):
+        return
+    for size in THUMB_SIZES:
+        t = asyncio.ensure_future(ensure_thumb(size, rel))
+        _thumb_tasks.add(t)
+        t.add_done_callback(_thumb_tasks.discard)
+
+@app.get("/media/{size}/{rel:path}")
+async def media(size: str, rel: str, if_none_match: Optional[str] = Header(None)):
+    if (size != "orig" and size not in THUMB_SIZES) or not _MEDIA_REL.match(rel):
+        raise HTTPException(status_code=404, detail="Not found")
+    orig = os.path.join(UPLOAD_DIR, rel)
+    if not os.path.exists(orig):
+        raise HTTPException(status_code=404, detail="Not found")
+    # содержимое определяется sha и размером — ETag сильный и вечный
+    etag = f'"{os.path.basename(rel).split(".")[0]}-{size}"'
+    headers = {"ETag": etag, "Cache-Control": IMMUTABLE_CACHE}
+    if if_none_match and etag in [t.strip() for t in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    path = await ensure_thumb(size, rel) if size != "orig" else None
+    if size != "orig" and (path is None or not os.path.exists(path)):
+        # превью не получилось — оригинал под этим URL только временно: без ETag (свой Starlette тоже убираем)
+        # и ненадолго, чтобы клиент потом получил настоящее превью
+        resp = FileResponse(orig, stat_result=os.stat(orig), headers={"Cache-Control": MEDIA_FALLBACK_CACHE})
+        del resp.headers["etag"]
+        return resp
+    if path is None:
+        return FileResponse(orig, headers=headers)
+    try:
+        if time.time() - os.path.getmtime(path) > THUMB_TOUCH_S:
+            os.utime(path)
+    except FileNotFoundError:
+        pass
+    return FileResponse(path, media_type="image/jpeg", headers=headers)
+
+# --- подготовка фото для vision: EXIF-поворот, уменьшение, JPEG ---
+VISION_MAX_SIDE = int(os.getenv("VISION_MAX_SIDE", "1280"))
+VISION_JPEG_QUALITY = int(os.getenv("VISION_JPEG_QUALITY", "85"))
+
+def prepare_for_vision(path: str) -> bytes:
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        with open(path, "rb") as f:
+            return f.read()
+    try:
+        with Image.open(path) as im:
+            im = ImageOps.exif_transpose(im)
+            if im.mode != "RGB":
+                im = im.convert("RGB")
+            im.thumbnail((VISION_MAX_SIDE, VISION_MAX_SIDE), Image.LANCZOS)
+            buf = io.BytesIO()
+            im.save(buf, "JPEG", quality=VISION_JPEG_QUALITY, optimize=True)
+            return buf.getvalue()
+    except Exception:
+        # не картинка или неизвестный формат — отдаём как есть, пусть решает модель
+        with open(path, "rb") as f:
+            return f.read()
+
+VISION_PROMPTS = {
+    "receipt": "Это фото кассового чека. Извлеки дату, время и позиции. Верни JSON:{\"date\":\"YYYY-MM-DD\",\"time\":\"HH:mm\",\"items\":[{\"name\":\"str\",\"grams\":int?,\"kcal\":int?}]}",
+    "photo": "Это фото блюда. Определи 1-3 блюда/компонента, оцени граммы и калории. Верни JSON:{\"items\":[{\"name\":\"str\",\"grams\":int,\"kcal\":int}]}",
+}
+_vision_flight = SingleFlight()
+vision_cache_stats = {"hits": 0, "misses": 0, "ai_calls": 0}
+
+async def recognize_image(sha: str, kind: str, path: str) -> dict:
+    # результат распознавания кэшируется по (sha, kind): повторная загрузка тех же байт не идёт в модель
+    row = await db.fetchone("SELECT data FROM vision_cache WHERE sha = ? AND kind = ?", (sha, kind))
+    if row:
+        vision_cache_stats["hits"] += 1
+        return json.loads(row[0])
+    vision_cache_stats["misses"] += 1
+
+    async def run() -> Optional[str]:
+        vision_cache_stats["ai_calls"] += 1
+        b64 = await asyncio.to_thread(lambda: base64.b64encode(prepare_for_vision(path)).decode("ascii"))
+        data = await ai_vision_parse(b64, VISION_PROMPTS[kind], fallback=False, path="receipt" if kind == "receipt" else "vision")
+        if data is None:
+            return None
+        payload = json.dumps(data, ensure_ascii=False)
+        async with db.write() as conn:
+            await conn.execute("INSERT OR REPLACE INTO vision_cache (sha, kind, data, created_at) VALUES (?, ?, ?, ?)",
+                               (sha, kind, payload, int(time.time())))
+        return payload
+
+    payload = await _vision_flight.do((sha, kind), run)
+    return json.loads(payload) if payload is not None else {"items":[{"name":"Блюдо","grams":0,"kcal":0}]}
 
 @app.post("/api/upload")
 async def upload_image(
     type: str = Form(...),
     file: UploadFile = File(...),
+    mode: str = Form("sync"),
     x_telegram_init_data: Optional[str] = Header(None)
 ):
     tg_id = await _resolve_tg_id(x_telegram_init_data)
-    user = await db_get_user(tg_id)
-    if not check_access(user):
+    if not await has_access(tg_id):
         raise HTTPException(status_code=402, detail="Subscription required")
 
-    content = await file.read()
-    if len(content) > 7_000_000:
-        raise HTTPException(status_code=413, detail="Image too large")
-    photo_url = save_file_local(content, file.filename)
+    tmp, sha, size, head = await spool_upload(file)
+    metrics.upload_bytes.observe(size, "receipt" if type == "receipt" else "photo")
+    photo_url, path = await asyncio.to_thread(store_spooled, tmp, sha, head, file.filename)
+    spawn_thumbs(photo_url)
+    if mode == "async":
+        # файл уже на диске: распознавание и запись уходят в очередь, клиент опрашивает статус
+        job_id = await enqueue_job(tg_id, "upload", {"type": type, "sha": sha, "path": path, "photo_url": photo_url})
+        return JSONResponse(status_code=202, content={"ok": True, "job_id": job_id, "status": "queued",
+                                                      "status_url": f"/api/jobs/{job_id}", "events_url": f"/api/jobs/{job_id}/events"})
+    return await process_upload(tg_id, type, sha, path, photo_url)
 
-    b64 = base64.b64encode(content).decode("utf-8")
-    prompt = ("Это фото кассового чека. Извлеки дату, время и позиции. Верни JSON:{\"date\":\"YYYY-MM-DD\",\"time\":\"HH:mm\",\"items\":[{\"name\":\"str\",\"grams\":int?,\"kcal\":int?}]}"
-              if type == "receipt" else
-              "Это фото блюда. Определи 1-3 блюда/компонента, оцени граммы и калории. Верни JSON:{\"items\":[{\"name\":\"str\",\"grams\":int,\"kcal\":int}]}")
-    data = await ai_vision_parse(b64, prompt)
+async def process_upload(tg_id: int, type: str, sha: str, path: str, photo_url: str, job: Optional[tuple] = None) -> dict:
+    # job — (id, claim) задачи из очереди; None — синхронная загрузка
+    data = await recognize_image(sha, "receipt" if type == "receipt" else "photo", path)
 
     used_time = "now"
     base_ts = now_utc()
@@ -355,32 +1030,246 @@ async def upload_image(
         except Exception:
             pass
 
-    items_out = []
+    items_out = []; rows = []
+    raw = json.dumps(data, ensure_ascii=False)
     for it in data.get("items", []):
         name = str(it.get("name","Блюдо"))[:200]
         grams = int(it.get("grams") or 0)
         kcal = int(it.get("kcal") or 0)
-        await db_insert_meal(
-            telegram_id=tg_id, ts=base_ts.isoformat(), calories=kcal, description="from photo",
-            item_name=name, grams=grams, source=("ocr" if type=="receipt" else "vision"),
-            photo_url=photo_url, raw_json=json.dumps(data, ensure_ascii=False),
+        rows.append(meal_row(
+            tg_id, base_ts, kcal, "from photo", name, grams, source=("ocr" if type=="receipt" else "vision"),
+            photo_url=photo_url, raw_json=raw,
             local_ts=(f"{data.get('date')} {data.get('time')}" if used_time=="receipt" else None)
-        )
+        ))
         items_out.append({"name": name, "grams": grams, "kcal": kcal, "ts": base_ts.isoformat()})
-    return {"ok": True, "inferred_type": type, "used_time": used_time, "items": items_out}
+    result = {"ok": True, "inferred_type": type, "used_time": used_time, "items": items_out,
+              "photo_url": photo_url, "thumb_url": media_url(photo_url, "thumb"), "preview_url": media_url(photo_url, "preview")}
+    # для задачи из очереди вместе с приёмами пищи пишется отметка job_applied: повтор после сбоя их не задвоит
+    await db_insert_meals(tg_id, rows, job_id=job[0] if job else None)
+    responses.invalidate(tg_id, "summary:")
+    if job is not None:
+        async with db.write() as conn:
+            await _job_finish(conn, *job, result)
+    return result
+
+# --- background jobs: таблица jobs + пул воркеров в процессе ---
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "4"))
+JOB_LEASE_S = int(os.getenv("JOB_LEASE_S", "300"))  # пока задача выполняется, аренда продлевается каждые JOB_LEASE_S/3
+JOB_POLL_S = float(os.getenv("JOB_POLL_S", "2"))
+JOB_WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+JOB_FINAL = ("done", "failed")
+
+_job_wakeup = asyncio.Event()
+_job_events: dict = {}  # job_id -> asyncio.Event для SSE в этом процессе
+
+def _job_notify(job_id: int):
+    ev = _job_events.get(job_id)
+    if ev is not None:
+        ev.set()
+
+async def enqueue_job(tg_id: int, kind: str, payload: dict) -> int:
+    now = int(time.time())
+    async with db.write() as conn:
+        cur = await conn.execute(
+            "INSERT INTO jobs (telegram_id, kind, status, payload, created_at, updated_at) VALUES (?, ?, 'queued', ?, ?, ?)",
+            (tg_id, kind, json.dumps(payload, ensure_ascii=False), now, now))
+        job_id = cur.lastrowid
+    _job_wakeup.set()
+    return job_id
+
+JOB_LEASE_EXPIRED = "lease expired: worker died or hung"
+
+async def _job_claim() -> Optional[tuple]:
+    # queued с наступившим run_after или running с истёкшей арендой (воркер умер) — под замком записи;
+    # если попытки уже исчерпаны (задача валит воркер), не берём её снова, а помечаем failed
+    now = int(time.time())
+    async with db.write() as conn:
+        exhausted = await conn.execute_fetchall(
+            "SELECT id, kind FROM jobs WHERE status = 'running' AND lease_until < ? AND attempts >= ?", (now, JOB_MAX_ATTEMPTS))
+        if exhausted:
+            await conn.executemany("UPDATE jobs SET status = 'failed', error = COALESCE(error, ?), lease_until = NULL, updated_at = ? "
+                                   "WHERE id = ?", [(JOB_LEASE_EXPIRED, now, jid) for jid, _ in exhausted])
+        rows = await conn.execute_fetchall(
+            "SELECT id, telegram_id, kind, payload, attempts FROM jobs "
+            "WHERE (status = 'queued' AND run_after <= ?) OR (status = 'running' AND lease_until < ?) ORDER BY id LIMIT 1",
+            (now, now))
+        if rows:
+            job_id, tg_id, kind, payload, attempts = rows[0]
+            # claim — метка именно этого захвата: воркеры одного процесса и повторный захват после истёкшей аренды
+            # различаются только по ней (worker — хост:pid, он нужен _job_recover)
+            claim = os.urandom(8).hex()
+            await conn.execute("UPDATE jobs SET status = 'running', attempts = ?, worker = ?, claim = ?, lease_until = ?, updated_at = ? "
+                               "WHERE id = ?", (attempts + 1, JOB_WORKER_ID, claim, now + JOB_LEASE_S, now, job_id))
+    for jid, k in exhausted:
+        metrics.jobs_total.inc(k, "failed")
+        _job_notify(jid)
+    if not rows:
+        return None
+    _job_notify(job_id)
+    return job_id, tg_id, kind, json.loads(payload), attempts + 1, claim
+
+class JobLost(Exception):
+    # аренду задачи забрал другой воркер — результат запишет он (приёмы пищи не задвоятся благодаря job_applied)
+    pass
+
+async def _job_heartbeat(job_id: int, claim: str):
+    # продлеваем аренду, пока задача выполняется: долгий вызов модели (повторы, ожидание семафоров) не должен
+    # отдать задачу второму воркеру; аренду отобрали — продлевать больше нечего
+    while True:
+        await asyncio.sleep(JOB_LEASE_S / 3)
+        try:
+            async with db.write() as conn:
+                cur = await conn.execute("UPDATE jobs SET lease_until = ? WHERE id = ? AND status = 'running' AND claim = ?",
+                                         (int(time.time()) + JOB_LEASE_S, job_id, claim))
+            if cur.rowcount != 1:
+                return
+        except Exception:
+            pass
+
+async def _job_finish(conn, job_id: int, claim: str, result: dict):
+    cur = await conn.execute(
+        "UPDATE jobs SET status = 'done', result = ?, error = NULL, lease_until = NULL, updated_at = ? "
+        "WHERE id = ? AND status = 'running' AND claim = ?",
+        (json.dumps(result, ensure_ascii=False), int(time.time()), job_id, claim))
+    if cur.rowcount != 1:
+        raise JobLost(job_id)
+
+async def _job_fail(job_id: int, claim: str, attempts: int, err: str):
+    now = int(time.time())
+    final = attempts >= JOB_MAX_ATTEMPTS
+    async with db.write() as conn:
+        await conn.execute("UPDATE jobs SET status = ?, error = ?, run_after = ?, lease_until = NULL, updated_at = ? "
+                           "WHERE id = ? AND status = 'running' AND claim = ?",
+                           ("failed" if final else "queued", err[:500],
+                            now + int(min(300, 5 * 2 ** attempts) * random.uniform(0.5, 1.0)), now, job_id, claim))
+    return final
+
+async def _job_run(job: tuple):
+    job_id, tg_id, kind, payload, attempts, claim = job
+    t0 = time.perf_counter()
+    hb = asyncio.ensure_future(_job_heartbeat(job_id, claim))
+    try:
+        if kind != "upload":
+            raise ValueError(f"unknown job kind {kind}")
+        await process_upload(tg_id, payload["type"], payload["sha"], payload["path"], payload["photo_url"], job=(job_id, claim))
+        metrics.jobs_total.inc(kind, "done")
+    except (asyncio.CancelledError, JobLost):
+        raise
+    except Exception as e:
+        final = await _job_fail(job_id, claim, attempts, f"{type(e).__name__}: {getattr(e, 'detail', None) or e}")
+        metrics.jobs_total.inc(kind, "failed" if final else "retry")
+    finally:
+        hb.cancel()
+        metrics.job_seconds.observe(time.perf_counter() - t0, kind)
+    _job_notify(job_id)
+
+async def _job_worker():
+    while True:
+        try:
+            job = await _job_claim()
+        except Exception:
+            job = None
+        if job is None:
+            try:
+                await asyncio.wait_for(_job_wakeup.wait(), JOB_POLL_S)
+            except asyncio.TimeoutError:
+                pass
+            _job_wakeup.clear()
+            continue
+        try:
+            await _job_run(job)
+        except JobLost:
+            pass
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+async def _job_recover():
+    # задачи, зависшие в running у умершего процесса на этом хосте, возвращаем в очередь сразу, не дожидаясь аренды.
+    # Наш собственный pid тоже «мёртвый»: на старте у нас ещё нет задач, значит это запись прошлого процесса
+    # с тем же pid (типично для контейнера, где API — pid 1). Исчерпавшие попытки — в failed, а не снова в очередь
+    host, me = socket.gethostname(), os.getpid()
+    rows = await db.fetchall("SELECT id, worker, attempts FROM jobs WHERE status = 'running' AND worker LIKE ?", (f"{host}:%",))
+    dead = [(jid, attempts) for jid, w, attempts in rows
+            if (pid := int(w.rsplit(":", 1)[1])) == me or not _pid_alive(pid)]
+    if dead:
+        now = int(time.time())
+        retry = [(now, jid) for jid, attempts in dead if attempts < JOB_MAX_ATTEMPTS]
+        give_up = [(JOB_LEASE_EXPIRED, now, jid) for jid, attempts in dead if attempts >= JOB_MAX_ATTEMPTS]
+        async with db.write() as conn:
+            await conn.executemany("UPDATE jobs SET status = 'queued', lease_until = NULL, updated_at = ? "
+                                   "WHERE id = ? AND status = 'running'", retry)
+            await conn.executemany("UPDATE jobs SET status = 'failed', error = COALESCE(error, ?), lease_until = NULL, updated_at = ? "
+                                   "WHERE id = ? AND status = 'running'", give_up)
+
+async def _job_status(job_id: int, tg_id: int) -> dict:
+    row = await db.fetchone("SELECT id, status, attempts, error, result, created_at, updated_at FROM jobs WHERE id = ? AND telegram_id = ?",
+                            (job_id, tg_id))
+    if not row:
+        raise HTTPException(status_code=404, detail="Job not found")
+    jid, status, attempts, error, result, created_at, updated_at = row
+    return {"id": jid, "status": status, "attempts": attempts, "error": error,
+            "result": json.loads(result) if result else None, "created_at": created_at, "updated_at": updated_at}
+
+@app.get("/api/jobs/{job_id}")
+async def job_status(job_id: int, x_telegram_init_data: Optional[str] = Header(None)):
+    tg_id = await _resolve_tg_id(x_telegram_init_data)
+    return await _job_status(job_id, tg_id)
+
+@app.get("/api/jobs/{job_id}/events")
+async def job_events(job_id: int, x_telegram_init_data: Optional[str] = Header(None)):
+    tg_id = await _resolve_tg_id(x_telegram_init_data)
+    first = await _job_status(job_id, tg_id)
+
+    async def stream():
+        ev = _job_events.setdefault(job_id, asyncio.Event())
+        try:
+            st, last, deadline = first, None, time.monotonic() + 600
+            while True:
+                key = (st["status"], st["attempts"], st["updated_at"])
+                if key != last:
+                    last = key
+                    yield f"event: status\ndata: {json.dumps(st, ensure_ascii=False)}\n\n"
+                if st["status"] in JOB_FINAL or time.monotonic() > deadline:
+                    return
+                try:
+                    # в этом процессе будит событие; задачи другого воркер-процесса видим по опросу
+                    await asyncio.wait_for(ev.wait(), 1.0)
+                except asyncio.TimeoutError:
+                    yield ": ping\n\n"
+                ev.clear()
+                st = await _job_status(job_id, tg_id)
+        finally:
+            _job_events.pop(job_id, None)
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 # Subscription: Stars
 @app.get("/api/subscribe/status")
-async def subscribe_status(x_telegram_init_data: Optional[str] = Header(None)):
+async def subscribe_status(request: Request, x_telegram_init_data: Optional[str] = Header(None)):
     tg_id = await _resolve_tg_id(x_telegram_init_data)
+    return await cached_json(request, tg_id, f"subscribe:{now_utc().date().isoformat()}", lambda: _build_subscribe_status(tg_id))
+
+async def _build_subscribe_status(tg_id: int) -> dict:
     user = await db_get_user(tg_id)
     now = now_utc()
     trial_days_left = None
     if user and user.get("trial_until"):
-        try:
-            trial_days_left = max(0, (dateparser.isoparse(user["trial_until"]) - now).days)
-        except Exception:
-            trial_days_left = 0
+        if user.get("plan") == "trial":
+            until = int(user.get("access_until") or 0)
+            trial_days_left = 0 if until >= db.ACCESS_FOREVER else max(0, (until - to_epoch(now)) // 86400)
+        else:
+            try:
+                trial_days_left = max(0, (dateparser.isoparse(user["trial_until"]) - now).days)
+            except Exception:
+                trial_days_left = 0
     return {
         "plan": user.get("plan","trial"),
         "trial_until": user.get("trial_until"),
@@ -397,8 +1286,10 @@ async def subscribe_create(x_telegram_init_data: Optional[str] = Header(None)):
         raise HTTPException(status_code=401, detail="Auth required")
 
     payload = f"sub_monthly:{tg_id}:{int(now_utc().timestamp())}"
-    prices = [{"label": "Monthly PRO", "amount": 599}]  # 599 Stars
+    return {"invoice_url": await tg_create_invoice_link(payload)}
 
+async def tg_create_invoice_link(payload: str) -> str:
+    prices = [{"label": "Monthly PRO", "amount": 599}]  # 599 Stars
     async with httpx.AsyncClient(timeout=20) as client:
         r = await client.post(f"{TELEGRAM_API}/createInvoiceLink", json={
             "title":"Calories PRO — 1 месяц",
@@ -410,4 +1301,4 @@ async def subscribe_create(x_telegram_init_data: Optional[str] = Header(None)):
         data = r.json()
         if not data.get("ok"):
             raise HTTPException(status_code=500, detail=f"Telegram error: {data}")
-        return {"invoice_url": data["result"]}
+        return data["result"]
@@ -1,13 +1,16 @@
 # main_ai_bot.py — Telegram бот: калории + Stars
 import os, json
 from datetime import datetime, timedelta, timezone
-import aiosqlite
+import db
+from cache import responses, entitlements
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, WebAppInfo, LabeledPrice
 from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes, MessageHandler, PreCheckoutQueryHandler, filters
 
-DB_PATH = os.getenv("CAL_DB_PATH", "calories_bot.db")
+DB_PATH = db.DB_PATH
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 WEBAPP_URL = os.getenv("WEBAPP_URL", "https://calories-webapp.onrender.com")
+# сколько апдейтов обрабатывается одновременно (и в polling, и в webhook внутри API)
+BOT_CONCURRENT_UPDATES = int(os.getenv("BOT_CONCURRENT_UPDATES", "16"))
 
 MONTH_PRICE_STARS = 599
 CURRENCY = "XTR"
@@ -16,13 +19,15 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     tg_id = update.effective_user.id
     now = datetime.now(timezone.utc)
     trial_until = (now + timedelta(days=7)).isoformat()
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
+    async with db.write() as conn:
+        await conn.execute(
             "INSERT INTO users (telegram_id, daily_goal, plan, trial_until) VALUES (?, ?, ?, ?) "
             "ON CONFLICT(telegram_id) DO UPDATE SET trial_until = COALESCE(users.trial_until, excluded.trial_until)",
             (tg_id, 2000, "trial", trial_until)
         )
-        await db.commit()
+        await db.refresh_access(conn, tg_id)
+    entitlements.pop(tg_id)
+    responses.invalidate(tg_id)
     kb = InlineKeyboardMarkup([[InlineKeyboardButton("Открыть трекер", web_app=WebAppInfo(url=WEBAPP_URL))],
                                [InlineKeyboardButton("Оформить PRO 599⭐", callback_data="subscribe")]])
     await update.message.reply_text("Добро пожаловать! 7-дневный триал активирован.", reply_markup=kb)
@@ -49,23 +54,46 @@ async def successful_payment_handler(update: Update, context: ContextTypes.DEFAU
     tg_id = update.effective_user.id
     now = datetime.now(timezone.utc)
     renews_at = now + timedelta(days=30)
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("INSERT OR IGNORE INTO users (telegram_id) VALUES (?)", (tg_id,))
-        await db.execute("UPDATE users SET plan = ?, renews_at = ?, payments_provider = ? WHERE telegram_id = ?",
-                         ("pro", renews_at.isoformat(), "stars", tg_id))
-        await db.execute("INSERT INTO payments (telegram_id, created_at, provider, amount_cents, currency, period_months, status, provider_payload) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
-                         (tg_id, now.isoformat(), "stars", MONTH_PRICE_STARS, CURRENCY, 1, "paid", json.dumps(sp.to_dict())))
-        await db.commit()
+    async with db.write() as conn:
+        # webhook отвечает 500 на упавший апдейт и Telegram присылает его снова — один платёж учитываем один раз
+        # (уникальный payments.charge_id: повтор не вставится, и подписку не трогаем)
+        cur = await conn.execute(
+            "INSERT INTO payments (telegram_id, created_at, provider, amount_cents, currency, period_months, status, provider_payload, charge_id) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT DO NOTHING",
+            (tg_id, now.isoformat(), "stars", MONTH_PRICE_STARS, CURRENCY, 1, "paid", json.dumps(sp.to_dict()), sp.telegram_payment_charge_id))
+        if cur.rowcount == 1:
+            await conn.execute("INSERT OR IGNORE INTO users (telegram_id) VALUES (?)", (tg_id,))
+            await conn.execute("UPDATE users SET plan = ?, renews_at = ?, payments_provider = ? WHERE telegram_id = ?",
+                               ("pro", renews_at.isoformat(), "stars", tg_id))
+            await db.refresh_access(conn, tg_id)
+    entitlements.pop(tg_id)
+    responses.invalidate(tg_id)
     await update.message.reply_text("Спасибо! Подписка PRO активирована на 1 месяц ✅")
 
-async def main():
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+async def _post_init(app):
+    await db.open_pool(DB_PATH)
+    await db.migrate()
+
+async def _post_shutdown(app):
+    await db.close_pool()
+
+def build_application(webhook: bool = False):
+    builder = ApplicationBuilder().token(BOT_TOKEN).concurrent_updates(BOT_CONCURRENT_UPDATES)
+    if webhook:
+        # апдейты приносит POST /telegram/webhook в fastapi_app; пул БД и миграции — на стороне API
+        builder = builder.updater(None)
+    else:
+        builder = builder.post_init(_post_init).post_shutdown(_post_shutdown)
+    app = builder.build()
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CommandHandler("subscribe", subscribe_cmd))
     app.add_handler(PreCheckoutQueryHandler(precheckout_handler))
     app.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, successful_payment_handler))
-    await app.run_polling()
+    return app
+
+def main():
+    # run_polling сам управляет циклом событий и вызывает post_init/post_shutdown
+    build_application().run_polling()
 
 if __name__ == "__main__":
-    import asyncio
-    asyncio.run(main())
+    main()
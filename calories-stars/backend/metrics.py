@@ -0,0 +1,165 @@
+# metrics.py — минимальные метрики в текстовом формате Prometheus без внешних зависимостей
+# Счётчики живут в процессе; observe/inc — пара dict-операций, так что их можно держать включёнными в проде.
+import time, asyncio
+from bisect import bisect_left
+from typing import Callable
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+BYTES_BUCKETS = (16e3, 64e3, 256e3, 512e3, 1e6, 2e6, 4e6, 7e6)
+
+_registry: list = []
+_collectors: list = []
+
+def _fmt_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(str(v))}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def _escape(v: str) -> str:
+    return v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _num(v: float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) and not v.is_integer() else str(int(v))
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name, self.help, self.labels = name, help, labels
+        self._v: dict = {}
+        _registry.append(self)
+
+    def inc(self, *labelvalues, value: float = 1.0):
+        self._v[labelvalues] = self._v.get(labelvalues, 0.0) + value
+
+    def render(self) -> list:
+        return [f"{self.name}{_fmt_labels(self.labels, k)} {_num(v)}" for k, v in self._v.items()]
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, *labelvalues, value: float):
+        self._v[labelvalues] = value
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name, self.help, self.labels = name, help, labels
+        self.buckets = tuple(buckets)
+        # labelvalues -> [counts по бакетам (+Inf последним), sum, count]
+        self._v: dict = {}
+        _registry.append(self)
+
+    def observe(self, value: float, *labelvalues):
+        st = self._v.get(labelvalues)
+        if st is None:
+            st = self._v[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        st[0][bisect_left(self.buckets, value)] += 1
+        st[1] += value
+        st[2] += 1
+
+    def time(self, *labelvalues):
+        return _Timer(self, labelvalues)
+
+    def render(self) -> list:
+        out = []
+        for k, (counts, total, n) in self._v.items():
+            acc = 0
+            for le, c in zip(self.buckets + (float("inf"),), counts):
+                acc += c
+                le_label = 'le="' + _num(le) + '"'
+                out.append(f"{self.name}_bucket{_fmt_labels(self.labels, k, le_label)} {acc}")
+            out.append(f"{self.name}_sum{_fmt_labels(self.labels, k)} {_num(total)}")
+            out.append(f"{self.name}_count{_fmt_labels(self.labels, k)} {n}")
+        return out
+
+class _Timer:
+    __slots__ = ("h", "labels", "t0")
+
+    def __init__(self, h: Histogram, labels: tuple):
+        self.h, self.labels = h, labels
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.h.observe(time.perf_counter() - self.t0, *self.labels)
+
+def register_collector(fn: Callable[[], list]):
+    # fn() -> [(name, kind, help, {labels_tuple_of_pairs: value})] — для значений, которые уже считаются в других модулях
+    _collectors.append(fn)
+
+def render() -> str:
+    lines = []
+    for m in _registry:
+        lines.append(f"# HELP {m.name} {m.help}")
+        lines.append(f"# TYPE {m.name} {m.kind}")
+        lines.extend(m.render())
+    for fn in _collectors:
+        for name, kind, help, samples in fn():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, v in samples.items():
+                names = tuple(n for n, _ in labels); values = tuple(v for _, v in labels)
+                lines.append(f"{name}{_fmt_labels(names, values)} {_num(v)}")
+    return "\n".join(lines) + "\n"
+
+# --- общие метрики ---
+http_request_seconds = Histogram("http_request_duration_seconds", "HTTP request latency by route", ("method", "route", "status"))
+db_statement_seconds = Histogram("db_statement_duration_seconds", "SQLite statement latency by operation and connection role", ("op", "role"))
+db_transaction_seconds = Histogram("db_transaction_duration_seconds", "SQLite write transaction latency (BEGIN..COMMIT)", ("kind",))
+db_wait_seconds = Histogram("db_connection_wait_seconds", "Time spent waiting for a reader connection or the writer lock", ("role",))
+db_group_commit_size = Histogram("db_group_commit_batch_size", "Jobs per group-commit transaction", (), buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+ai_request_seconds = Histogram("ai_request_duration_seconds", "OpenAI call latency", ("model", "path", "outcome"))
+ai_tokens = Counter("ai_tokens_total", "OpenAI tokens used", ("model", "path", "type"))
+ai_retries = Counter("ai_retries_total", "OpenAI call retries", ("model", "path"))
+upload_bytes = Histogram("upload_size_bytes", "Uploaded file size", ("type",), buckets=BYTES_BUCKETS)
+jobs_total = Counter("jobs_total", "Background jobs finished by kind and outcome", ("kind", "outcome"))
+job_seconds = Histogram("job_duration_seconds", "Background job run time", ("kind",))
+entitlements_active = Gauge("entitlements_active", "Users with access at the last sweep")
+entitlements_expiring = Gauge("entitlements_expiring", "Users whose access ends within ENTITLEMENT_EXPIRING_S")
+entitlements_expired = Counter("entitlements_expired_total", "Accesses seen expiring by the sweeper")
+bot_update_errors = Counter("bot_update_errors_total", "Webhook updates whose handler raised (answered 500)", ("error",))
+retention_removed = Counter("retention_removed_total", "Items removed by the retention pass", ("kind",))
+event_loop_lag = Gauge("event_loop_lag_seconds", "Last measured event loop scheduling lag")
+event_loop_lag_hist = Histogram("event_loop_lag_distribution_seconds", "Event loop scheduling lag", ())
+
+# --- ASGI middleware ---
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        t0 = time.perf_counter()
+        status = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # шаблон пути (/api/meal/{meal_id}), а не сам путь — иначе кардинальность меток не ограничена
+            route = getattr(scope.get("route"), "path", None) or scope.get("root_path") or "unmatched"
+            http_request_seconds.observe(time.perf_counter() - t0, scope["method"], route, str(status[0]))
+
+# --- event loop lag ---
+async def watch_event_loop(interval: float = 0.5):
+    while True:
+        t0 = time.perf_counter()
+        await asyncio.sleep(interval)
+        lag = max(0.0, time.perf_counter() - t0 - interval)
+        event_loop_lag.set(value=lag)
+        event_loop_lag_hist.observe(lag)
+
+def sql_op(sql: str) -> str:
+    head = sql.lstrip()[:8].split(None, 1)
+    return head[0].lower() if head else "?"
@@ -0,0 +1,139 @@
+# reshard_db.py — офлайн-перенос meals/daily_totals между основным файлом и шардами (CAL_DB_SHARDS)
+#
+#   python reshard_db.py --to 4             # основной calories_bot.db -> 4 шарда
+#   python reshard_db.py --from 4 --to 8    # 4 шарда -> 8
+#   python reshard_db.py --from 4 --to 1    # обратно в один файл
+#
+# API и бот на время переноса должны быть остановлены. После успешного прогона выстави CAL_DB_SHARDS=<to>.
+# Источник очищается только после сверки количества и суммы калорий (--keep-source оставляет его как есть).
+import os, sys, time, sqlite3, asyncio, argparse
+import db
+
+COPY_CHUNK = 50_000
+COLUMNS = ("id",) + db.MEAL_COLUMNS
+
+def layout(path: str, n: int) -> list:
+    return [path] if n <= 1 else [db.shard_path(i, n, path) for i in range(n)]
+
+async def prepare(paths: list):
+    # схема во всех файлах одна — просто прогоняем миграции
+    for path in paths:
+        p = await db.Pool(path, readers=1).open()
+        try:
+            await db.migrate(p)
+        finally:
+            await p.close()
+
+def totals(con) -> tuple:
+    n, kcal = con.execute("SELECT COUNT(*), COALESCE(SUM(calories), 0) FROM meals").fetchone()
+    return int(n), int(kcal)
+
+def copy_payload(src, dst, payload_id: int):
+    # payload_id локален для файла: переносим сам ответ (сжатый, как есть) и берём id в назначении
+    row = src.execute("SELECT sha, data, created_at FROM ai_payloads WHERE id = ?", (payload_id,)).fetchone()
+    if row is None:
+        return None
+    dst.execute("INSERT INTO ai_payloads (sha, data, created_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(sha) DO UPDATE SET created_at = MAX(created_at, excluded.created_at)", row)
+    return dst.execute("SELECT id FROM ai_payloads WHERE sha = ?", (row[0],)).fetchone()[0]
+
+def reshard(path: str, src_n: int, dst_n: int, keep_source: bool = False, log=print) -> dict:
+    if src_n == dst_n:
+        raise SystemExit("--from and --to are the same")
+    sources, targets = layout(path, src_n), layout(path, dst_n)
+    for f in sources:
+        if not os.path.exists(f):
+            raise SystemExit(f"source {f} not found")
+    asyncio.run(prepare(sorted({path, *targets})))
+
+    src = [sqlite3.connect(f, isolation_level=None) for f in sources]
+    dst = [sqlite3.connect(f, isolation_level=None) for f in targets]
+    try:
+        for f, con in zip(targets, dst):
+            if f not in sources and con.execute("SELECT 1 FROM meals LIMIT 1").fetchone():
+                raise SystemExit(f"target {f} already has meals; remove it or finish the previous run by hand")
+        # id сохраняем, только если источник один — иначе id из разных шардов могут совпасть
+        cols = COLUMNS if len(sources) == 1 else db.MEAL_COLUMNS
+        insert = f"INSERT INTO meals ({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))})"
+        tg_idx, pid_idx = cols.index("telegram_id"), cols.index("payload_id")
+        before = [totals(c) for c in src]
+        for con in dst:
+            con.execute("PRAGMA synchronous=OFF")
+            con.execute("BEGIN IMMEDIATE")
+        t0 = time.perf_counter(); copied = 0
+        for f, con in zip(sources, src):
+            remap: dict = {}  # (шард назначения, payload_id в источнике) -> payload_id в назначении
+            cur = con.execute(f"SELECT {', '.join(cols)} FROM meals ORDER BY id")
+            while True:
+                rows = cur.fetchmany(COPY_CHUNK)
+                if not rows:
+                    break
+                parts: list = [[] for _ in dst]
+                for r in rows:
+                    t = db.shard_for(r[tg_idx], dst_n)
+                    if r[pid_idx] is not None:
+                        key = (t, r[pid_idx])
+                        if key not in remap:
+                            remap[key] = copy_payload(con, dst[t], r[pid_idx])
+                        r = r[:pid_idx] + (remap[key],) + r[pid_idx + 1:]
+                    parts[t].append(r)
+                for tcon, part in zip(dst, parts):
+                    if part:
+                        tcon.executemany(insert, part)
+                copied += len(rows)
+            log(f"{os.path.basename(f)}: copied, {copied} rows so far ({time.perf_counter() - t0:.1f}s)")
+            # отметки выполненных задач нужны там, куда уехали приёмы пищи; какой это шард — неизвестно, копируем во все
+            applied = con.execute("SELECT job_id, applied_at FROM job_applied").fetchall()
+            for tcon in dst:
+                tcon.executemany("INSERT OR IGNORE INTO job_applied (job_id, applied_at) VALUES (?, ?)", applied)
+        for tcon in dst:
+            tcon.execute("DELETE FROM daily_totals")
+            tcon.execute(db.DAILY_TOTALS_REBUILD_SQL, db.DAILY_TOTALS_REBUILD_PARAMS)
+        after = [totals(c) for c in dst]
+        want = (sum(n for n, _ in before), sum(k for _, k in before))
+        got = (sum(n for n, _ in after), sum(k for _, k in after))
+        if got != want:
+            for tcon in dst:
+                tcon.execute("ROLLBACK")
+            raise SystemExit(f"verification failed: source {want}, target {got}; nothing changed")
+        for tcon in dst:
+            tcon.execute("COMMIT")
+            tcon.execute("ANALYZE")
+    finally:
+        for con in src + dst:
+            con.close()
+
+    if not keep_source:
+        for f in sources:
+            if f in targets:
+                continue
+            if f == path:
+                con = sqlite3.connect(f, isolation_level=None)
+                con.execute("BEGIN IMMEDIATE")
+                for table in ("meals", "daily_totals", "job_applied", "ai_payloads"):
+                    con.execute(f"DELETE FROM {table}")
+                con.execute("COMMIT")
+                con.close()
+            else:
+                for suffix in ("", "-wal", "-shm"):
+                    if os.path.exists(f + suffix):
+                        os.remove(f + suffix)
+    return {"rows": got[0], "kcal": got[1], "sources": sources, "targets": targets, "renumbered": len(sources) > 1}
+
+def parse_args(argv=None):
+    ap = argparse.ArgumentParser(description="Move meals between the main SQLite file and hash shards (offline)")
+    ap.add_argument("--db", default=db.DB_PATH, help="основной файл БД (по умолчанию CAL_DB_PATH)")
+    ap.add_argument("--from", dest="src", type=int, default=1, help="текущее число шардов (1 — всё в основном файле)")
+    ap.add_argument("--to", dest="dst", type=int, required=True, help="новое число шардов")
+    ap.add_argument("--keep-source", action="store_true", help="не очищать источник после переноса")
+    return ap.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    res = reshard(args.db, args.src, args.dst, args.keep_source)
+    print(f"done: {res['rows']} meals, {res['kcal']} kcal in {len(res['targets'])} file(s)"
+          + (" (meal ids renumbered)" if res["renumbered"] else ""))
+    print(f"set CAL_DB_SHARDS={args.dst}")
+
+if __name__ == "__main__":
+    sys.exit(main())